@@ -0,0 +1,216 @@
+# Copyright (c) 2013 Sylvia van Os
+# This file is part of Triggerbot, released under the MIT license
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Runs filter evaluation in a pool of worker processes (see filterworker.py),
+# so matching messages against the trigger vocabulary doesn't hold up the
+# reactor.
+
+import collections
+import os.path
+import sys
+
+from twisted.internet import reactor, protocol, defer
+from twisted.python import log, failure
+
+import filterworker
+
+class WorkerLost(Exception):
+    pass
+
+class Barrier(object):
+    """An entry in the queues of several keys, delivered once it is first in all of them."""
+    def __init__(self, keys, callback):
+        self.keys = keys
+        self.waiting = set(keys)
+        self.callback = callback
+
+class FilterWorker(protocol.ProcessProtocol):
+    """Talks to a single worker process."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.buffer = ""
+        self.pending = {} # request id -> Deferred
+
+    def send(self, message):
+        self.transport.write(filterworker.encode(message))
+
+    def outReceived(self, data):
+        self.buffer += data
+        while True:
+            message, self.buffer = filterworker.decode(self.buffer)
+            if message is None:
+                break
+            kind, requestid, matched = message
+            self.pending.pop(requestid).callback(matched)
+
+    def errReceived(self, data):
+        log.msg("Filter worker: %s" % data.rstrip())
+
+    def processEnded(self, reason):
+        log.msg("Filter worker ended: %s" % reason.getErrorMessage())
+        self.pool.worker_ended(self)
+        pending, self.pending = self.pending, {}
+        for deferred in pending.itervalues():
+            deferred.errback(WorkerLost())
+
+class FilterPool(object):
+    """
+    A pool of filter worker processes.
+    Once attached to a bot's Vocabulary and TopicDetector, every worker
+    gets a snapshot of them, and their journals are pushed to all workers
+    before each new request, so a request is never matched against an
+    older vocabulary than the one it was made with.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.workers = []
+        self.vocabulary = None
+        self.topic_detector = None
+        self.requestid = 0
+        self.queues = {} # ordering key -> deque of ([done, result], callback)
+        self.requests = 0
+        self.lost = 0
+
+    def start(self):
+        for x in range(self.size):
+            self.spawn()
+
+    def spawn(self):
+        worker = FilterWorker(self)
+        directory = os.path.dirname(os.path.abspath(filterworker.__file__))
+        reactor.spawnProcess(worker, sys.executable, [sys.executable, "-m", "filterworker"],
+                             env=os.environ, path=directory)
+        self.workers.append(worker)
+        if self.vocabulary is not None:
+            worker.send(("changes", self.snapshot()))
+
+    def worker_ended(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+
+    def attach(self, vocabulary, topic_detector):
+        """Replicate a (new) vocabulary and topic detector to every worker."""
+        if self.vocabulary is not None:
+            self.vocabulary.journal = None
+            self.topic_detector.journal = None
+        self.vocabulary = vocabulary
+        self.topic_detector = topic_detector
+        vocabulary.journal = []
+        topic_detector.journal = []
+        snapshot = self.snapshot()
+        for worker in self.workers:
+            worker.send(("changes", snapshot))
+
+    def snapshot(self):
+        return [("reset",)] + self.vocabulary.snapshot() + self.topic_detector.snapshot()
+
+    def flush(self):
+        """Push the changes made since the last request to every worker."""
+        changes = self.vocabulary.journal + self.topic_detector.journal
+        if changes:
+            for worker in self.workers:
+                worker.send(("changes", changes))
+            del self.vocabulary.journal[:]
+            del self.topic_detector.journal[:]
+
+    def matched_terms(self, message, detect):
+        """
+        Returns a Deferred firing with a worker's FilterReplica.matched_terms
+        for message. It fires with None when there's no worker to ask.
+        """
+        if not self.workers:
+            return defer.succeed(None)
+        self.flush()
+        self.requestid += 1
+        self.requests += 1
+        worker = min(self.workers, key=lambda worker: len(worker.pending))
+        deferred = defer.Deferred()
+        worker.pending[self.requestid] = deferred
+        worker.send(("filter", self.requestid, message, detect))
+        return deferred
+
+    def ordered(self, key, deferred, callback):
+        """
+        Call callback with the result of deferred, but never before the
+        callbacks of all deferreds given earlier for the same key.
+        A failed deferred gives None instead of its result.
+        """
+        entry = [False, None]
+        self.queues.setdefault(key, collections.deque()).append((entry, callback))
+        def done(result):
+            if isinstance(result, failure.Failure):
+                self.lost += 1
+                result = None
+            entry[0] = True
+            entry[1] = result
+            self.deliver(key)
+        deferred.addBoth(done)
+
+    def ordered_all(self, keys, callback):
+        """
+        Call callback once everything given to ordered earlier for any of
+        keys got its callback called, and before anything given later for
+        them.
+        """
+        keys = set(keys)
+        if not keys:
+            callback()
+            return
+        barrier = Barrier(keys, callback)
+        for key in keys:
+            self.queues.setdefault(key, collections.deque()).append((None, barrier))
+        for key in keys:
+            self.deliver(key)
+
+    def deliver(self, key):
+        queue = self.queues.get(key)
+        while queue:
+            entry, callback = queue[0]
+            if isinstance(callback, Barrier):
+                callback.waiting.discard(key)
+                if callback.waiting:
+                    break # Still behind other entries for another key
+                for other in callback.keys:
+                    self.queues[other].popleft()
+                try:
+                    callback.callback()
+                except Exception:
+                    log.err()
+                for other in callback.keys:
+                    if other != key:
+                        self.deliver(other)
+                continue
+            if not entry[0]:
+                break
+            queue.popleft()
+            try:
+                callback(entry[1])
+            except Exception:
+                log.err()
+        # A callback may have started a new queue for this key already
+        if queue is not None and not queue and self.queues.get(key) is queue:
+            del self.queues[key]
+
+    def stats(self):
+        return "%d/%d workers, %d requests, %d waiting, %d lost to dead workers" % \
+            (len(self.workers), self.size, self.requests,
+             sum(len(worker.pending) for worker in self.workers), self.lost)
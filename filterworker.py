@@ -0,0 +1,78 @@
+# Copyright (c) 2013 Sylvia van Os
+# This file is part of Triggerbot, released under the MIT license
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# A filter worker process, started by filterpool.FilterPool.
+# It keeps a replica of the bot's trigger vocabulary up to date with the
+# changes it is sent, and replies with the matched terms of every message
+# it is asked to filter. Messages both ways are pickles, each preceded by
+# their length as a 4 byte big endian integer.
+
+import struct
+import sys
+import cPickle
+
+import xapian
+import triggerfilter
+
+HEADER = struct.Struct("!I")
+
+def encode(message):
+    data = cPickle.dumps(message, cPickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+def decode(buffer):
+    """
+    Returns (message, rest of the buffer), or (None, buffer) if buffer
+    doesn't hold a complete message yet.
+    """
+    if len(buffer) < HEADER.size:
+        return None, buffer
+    length, = HEADER.unpack(buffer[:HEADER.size])
+    end = HEADER.size + length
+    if len(buffer) < end:
+        return None, buffer
+    return cPickle.loads(buffer[HEADER.size:end]), buffer[end:]
+
+def read_message(stream):
+    header = stream.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length, = HEADER.unpack(header)
+    return cPickle.loads(stream.read(length))
+
+def main():
+    replica = triggerfilter.FilterReplica(xapian.Stem("en"))
+    while True:
+        message = read_message(sys.stdin)
+        if message is None:
+            # The bot went away
+            break
+        if message[0] == "changes":
+            for change in message[1]:
+                replica.apply(change)
+        elif message[0] == "filter":
+            requestid, text, detect = message[1:]
+            sys.stdout.write(encode(("matched", requestid, replica.matched_terms(text, detect))))
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,605 @@
+# Copyright (c) 2013 Sylvia van Os
+# This file is part of Triggerbot, released under the MIT license
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Where the bot keeps its users, topics, channels and settings between runs.
+# PickleStore writes them all to a single pickle, like triggerbot always has.
+# The other stores split them into rows: one for every user, topic, channel
+# and setting, and one for every topic word list, mail, warning and log
+# entry. They only write the rows which changed since the last save:
+# SQLiteStore to tables of an SQLite database, JournalStore by appending
+# them to a journal which is folded into a snapshot once in a while.
+
+import cPickle
+import cStringIO
+import datetime
+import errno
+import hashlib
+import os
+import struct
+import time
+import traceback
+
+from twisted.internet import process
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+KINDS = ("pickle", "sqlite", "journal")
+KIND_NAMES = {"pickle": "a pickle", "sqlite": "an SQLite", "journal": "a journal"}
+SQLITE_HEADER = "SQLite format 3\0"
+JOURNAL_HEADER = "triggerbot journal\n"
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
+
+# Table and key column of each kind of object, in the order of the state tuple
+OBJECT_TABLES = (("users", "nick"), ("topics", "name"), ("channels", "name"), ("settings", "name"))
+# Tables holding the entries of these dictionaries of users, keyed by time
+ENTRY_TABLES = ("messages", "warnings", "logs")
+
+class StorageError(Exception):
+    pass
+
+def detect(filename):
+    """ The kind of an existing database file """
+    with open(filename, "rb") as f:
+        header = f.read(max(len(SQLITE_HEADER), len(JOURNAL_HEADER)))
+    if header.startswith(SQLITE_HEADER):
+        return "sqlite"
+    elif header.startswith(JOURNAL_HEADER):
+        return "journal"
+    return "pickle"
+
+def open_store(filename, kind, classes, background=False, log=None):
+    """
+    Open a database file as a store of the given kind, or of the kind the
+    file turns out to be if kind is None. A pickle opened as another kind
+    of store is converted first. classes maps each table to the class of
+    its objects. Pickles can be saved in the background, reporting to log.
+    """
+    existing = detect(filename) if os.path.exists(filename) else None
+    if kind is None:
+        kind = existing or "pickle"
+    if not kind in KINDS:
+        raise StorageError("Unknown storage %r, use one of %s" % (kind, ", ".join(KINDS)))
+    if existing and existing != kind and existing != "pickle":
+        raise StorageError("%s is %s database, use --storage %s" % (filename, KIND_NAMES[existing], existing))
+    if kind == "pickle":
+        return PickleStore(filename, background, log)
+    if background:
+        raise StorageError("Only pickle databases can be saved in the background")
+    if kind == "sqlite" and sqlite3 is None:
+        raise StorageError("SQLite storage needs Python's sqlite3 module")
+    store = {"sqlite": SQLiteStore, "journal": JournalStore}[kind]
+    if existing == "pickle":
+        migrate(filename, store, classes)
+    return store(filename, classes)
+
+def migrate(filename, store, classes):
+    """ Convert a pickle database to another kind of store, keeping the pickle as filename.pickle """
+    state = PickleStore(filename).load()
+    converted = "%s.migrating" % filename
+    store.remove(converted)
+    converting = store(converted, classes)
+    converting.save(*state)
+    converting.close()
+    os.rename(filename, "%s.pickle" % filename)
+    store.rename(converted, filename)
+
+class PickleStore(object):
+    """
+    Everything in a single pickle, written completely on every save. It is
+    written next to the database and renamed over it once it's on disk, so
+    a crash while saving leaves the previous save intact. In the background,
+    a forked child writes it from its own copy of the state while the bot
+    carries on.
+    """
+    commit_interval = None # Seconds between saves if more often than every minute
+    def __init__(self, filename, background=False, log=None):
+        self.filename = filename
+        self.background = background
+        self.log = log or (lambda message: None)
+        self.child = None # BackgroundSave still writing
+        self.pending = None # State to save once it's done
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def load(self):
+        with open(self.filename, "r") as f:
+            return cPickle.load(f)
+
+    def write(self, state):
+        temporary = "%s.tmp" % self.filename
+        with open(temporary, "wb") as f:
+            cPickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.filename)
+
+    def save(self, users, topics, channels, settings, dirty=None):
+        """ Write everything, whatever is dirty. Returns the number of objects written. """
+        state = (users, topics, channels, settings)
+        if not self.background:
+            self.write(state)
+        elif self.child is not None:
+            # Never two at once, the latest state is saved after this one
+            self.pending = state
+        else:
+            self.child = BackgroundSave(self, state)
+            try:
+                self.child.start()
+            except OSError as e:
+                self.child = None
+                self.log("Could not fork to save in the background (%s), saving now." % e.strerror)
+                self.write(state)
+        return sum(len(objects) for objects in state)
+
+    def saved(self, child, succeeded):
+        """ Called once a BackgroundSave has ended """
+        self.child = None
+        if succeeded:
+            self.log("Saved state in the background: %d bytes in %.2f seconds." %
+                     (os.path.getsize(self.filename), time.time() - child.started))
+        else:
+            self.log("Saving state in the background failed, saving now.")
+            self.write(child.state)
+        if self.pending is not None:
+            state, self.pending = self.pending, None
+            self.save(*state)
+
+    def close(self):
+        if self.child is not None:
+            self.child.wait()
+        if self.pending is not None:
+            state, self.pending = self.pending, None
+            self.write(state)
+
+class BackgroundSave(object):
+    """
+    A forked child writing a PickleStore's pickle. Twisted reaps it like the
+    processes it spawns itself, through reapProcess and processEnded.
+    """
+    def __init__(self, store, state):
+        self.store = store
+        self.state = state
+        self.started = None
+        self.pid = None
+
+    def start(self):
+        self.started = time.time()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 1
+            try:
+                self.store.write(self.state)
+                status = 0
+            except:
+                traceback.print_exc()
+            os._exit(status)
+        process.registerReapProcessHandler(self.pid, self)
+
+    def reapProcess(self):
+        try:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            pid, status = self.pid, None
+        if pid:
+            process.unregisterReapProcessHandler(pid, self)
+            self.processEnded(status)
+
+    def wait(self):
+        """ Block until the child is done """
+        try:
+            pid, status = os.waitpid(self.pid, 0)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            status = None
+        process.unregisterReapProcessHandler(self.pid, self)
+        self.processEnded(status)
+
+    def processEnded(self, status):
+        self.store.saved(self, status is not None and os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0)
+
+class RowStore(object):
+    """
+    Turns the bot's state into rows and back. Each row is a pickle, in
+    which other users, topics, channels and settings are stored by their
+    key. Rows are keyed by (table, key) for objects and topic words, and
+    (table, nick, time) for entries.
+    """
+    commit_interval = None
+
+    def __init__(self, classes):
+        self.classes = classes
+        self.written = {} # row key -> digest of what was last written
+        self.owned = {} # (table, key) -> row keys written for that object
+
+    def dumps(self, value, references):
+        pickled = cStringIO.StringIO()
+        pickler = cPickle.Pickler(pickled, 2)
+        pickler.persistent_id = lambda obj: references.get(id(obj))
+        pickler.dump(value)
+        return pickled.getvalue()
+
+    def loads(self, data, resolve):
+        unpickler = cPickle.Unpickler(cStringIO.StringIO(data))
+        unpickler.persistent_load = resolve
+        return unpickler.load()
+
+    @staticmethod
+    def owner(row):
+        """ The (table, key) of the object a row belongs to """
+        if row[0] in ENTRY_TABLES:
+            return ("users", row[1])
+        elif row[0] == "topic_words":
+            return ("topics", row[1])
+        return row[:2]
+
+    def references(self, state):
+        """ {id: (table, key)} of the objects in a (users, topics, channels, settings) tuple """
+        references = {}
+        for (table, key), objects in zip(OBJECT_TABLES, state):
+            for name, obj in objects.iteritems():
+                references[id(obj)] = (table, name)
+        return references
+
+    def encode_object(self, table, name, obj, references):
+        """ {row key: pickle} of a single user, topic, channel or setting """
+        rows = {}
+        if hasattr(obj, "__getstate__"):
+            objstate = obj.__getstate__()
+        else:
+            objstate = obj.__dict__.copy()
+        if table == "users":
+            for entrytable in ENTRY_TABLES:
+                for at, entry in objstate.pop(entrytable, {}).iteritems():
+                    rows[(entrytable, name, at.strftime(TIME_FORMAT))] = self.dumps(entry, references)
+        elif table == "topics":
+            rows[("topic_words", name)] = self.dumps(objstate.pop("words", {}), references)
+        # Sorted, so equal states are pickled the same
+        rows[(table, name)] = self.dumps(sorted(objstate.iteritems()), references)
+        return rows
+
+    def encode(self, state):
+        """ {row key: pickle} of a (users, topics, channels, settings) tuple """
+        references = self.references(state)
+        rows = {}
+        for (table, key), objects in zip(OBJECT_TABLES, state):
+            for name, obj in objects.iteritems():
+                rows.update(self.encode_object(table, name, obj, references))
+        return rows
+
+    def decode(self, rows):
+        """ The (users, topics, channels, settings) tuple stored in {row key: pickle} """
+        state = tuple({} for table in OBJECT_TABLES)
+        tables = dict(zip((table for table, key in OBJECT_TABLES), state))
+        for row in rows:
+            if row[0] in tables:
+                cls = self.classes[row[0]]
+                tables[row[0]][row[1]] = cls.__new__(cls)
+        gone = {}
+        def resolve(reference):
+            table, name = reference
+            obj = tables[table].get(name)
+            if obj is None:
+                # Referred to, but removed since. Like in a pickle, it lives on detached.
+                obj = gone.get(reference)
+                if obj is None:
+                    obj = gone[reference] = self.classes[table](name)
+            return obj
+        entries = {}
+        words = {}
+        for row, data in rows.iteritems():
+            if row[0] in ENTRY_TABLES:
+                entries.setdefault((row[0], row[1]), {})[datetime.datetime.strptime(row[2], TIME_FORMAT)] = self.loads(data, resolve)
+            elif row[0] == "topic_words":
+                words[row[1]] = self.loads(data, resolve)
+        for row, data in rows.iteritems():
+            if not row[0] in tables:
+                continue
+            obj = tables[row[0]][row[1]]
+            objstate = dict(self.loads(data, resolve))
+            if row[0] == "users":
+                for entrytable in ENTRY_TABLES:
+                    objstate[entrytable] = entries.get((entrytable, row[1]), {})
+            elif row[0] == "topics":
+                objstate["words"] = words.get(row[1], {})
+            if hasattr(obj, "__setstate__"):
+                obj.__setstate__(objstate)
+            else:
+                obj.__dict__.update(objstate)
+        self.written = dict((row, hashlib.sha1(data).digest()) for row, data in rows.iteritems())
+        self.owned = {}
+        for row in rows:
+            self.owned.setdefault(self.owner(row), set()).add(row)
+        return state
+
+    def changes(self, state, dirty=None):
+        """
+        The rows which changed since they were last written, as a list of
+        (row key, pickle), the row keys which are gone, and the number of
+        objects written or removed. Only objects in dirty and objects not
+        written before are encoded, or all of them if dirty is None.
+        """
+        references = self.references(state)
+        if dirty is not None:
+            dirty = set(id(obj) for obj in dirty)
+        tables = dict(zip((table for table, key in OBJECT_TABLES), state))
+        changed = []
+        removed = []
+        objects = 0
+        for (table, key), tableobjects in zip(OBJECT_TABLES, state):
+            for name, obj in tableobjects.iteritems():
+                owned = self.owned.get((table, name))
+                if dirty is not None and owned is not None and not id(obj) in dirty:
+                    continue
+                rows = self.encode_object(table, name, obj, references)
+                before = len(changed) + len(removed)
+                for row, data in rows.iteritems():
+                    digest = hashlib.sha1(data).digest()
+                    if self.written.get(row) != digest:
+                        self.written[row] = digest
+                        changed.append((row, data))
+                for row in owned or ():
+                    if not row in rows:
+                        del self.written[row]
+                        removed.append(row)
+                self.owned[(table, name)] = set(rows)
+                if len(changed) + len(removed) > before:
+                    objects += 1
+        for table, name in self.owned.keys():
+            if not name in tables[table]:
+                for row in self.owned.pop((table, name)):
+                    del self.written[row]
+                    removed.append(row)
+                objects += 1
+        return changed, removed, objects
+
+class SQLiteStore(RowStore):
+    """ Rows in the tables of an SQLite database, written in one transaction per save """
+    def __init__(self, filename, classes):
+        RowStore.__init__(self, classes)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            for table, key in OBJECT_TABLES:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (%s TEXT PRIMARY KEY, state BLOB NOT NULL)" % (table, key))
+            self.db.execute("CREATE TABLE IF NOT EXISTS topic_words (topic TEXT NOT NULL, level INTEGER NOT NULL,"
+                            " position INTEGER NOT NULL, word TEXT NOT NULL, PRIMARY KEY (topic, level, position))")
+            for table in ENTRY_TABLES:
+                self.db.execute("CREATE TABLE IF NOT EXISTS %s (nick TEXT NOT NULL, at TEXT NOT NULL,"
+                                " entry BLOB NOT NULL, PRIMARY KEY (nick, at))" % table)
+
+    @staticmethod
+    def remove(filename):
+        for name in (filename, "%s-wal" % filename, "%s-shm" % filename):
+            if os.path.exists(name):
+                os.remove(name)
+
+    @staticmethod
+    def rename(filename, newname):
+        # Closed cleanly, so there's no -wal file to take along
+        os.rename(filename, newname)
+
+    def exists(self):
+        return self.db.execute("SELECT 1 FROM settings LIMIT 1").fetchone() is not None
+
+    def close(self):
+        self.db.close()
+
+    def load(self):
+        rows = {}
+        for table, key in OBJECT_TABLES:
+            for name, data in self.db.execute("SELECT %s, state FROM %s" % (key, table)):
+                rows[(table, name)] = str(data)
+        for table in ENTRY_TABLES:
+            for nick, at, data in self.db.execute("SELECT nick, at, entry FROM %s" % table):
+                rows[(table, nick, at)] = str(data)
+        words = {}
+        for topic, level, position, word in self.db.execute("SELECT topic, level, position, word FROM topic_words ORDER BY topic, level, position"):
+            words.setdefault(topic, {}).setdefault(level, []).append(word)
+        for row in rows.keys():
+            if row[0] == "topics":
+                rows[("topic_words", row[1])] = self.dumps(words.get(row[1], {}), {})
+        return self.decode(rows)
+
+    def save(self, users, topics, channels, settings, dirty=None):
+        """
+        Write what changed since the last save, looking only at the objects
+        in dirty unless it is None. Returns the number of objects written.
+        """
+        changed, removed, objects = self.changes((users, topics, channels, settings), dirty)
+        with self.db:
+            for row in removed:
+                self.delete(row)
+            for row, data in changed:
+                self.write(row, data)
+        return objects
+
+    def delete(self, row):
+        if row[0] == "topic_words":
+            self.db.execute("DELETE FROM topic_words WHERE topic = ?", row[1:])
+        elif row[0] in ENTRY_TABLES:
+            self.db.execute("DELETE FROM %s WHERE nick = ? AND at = ?" % row[0], row[1:])
+        else:
+            self.db.execute("DELETE FROM %s WHERE %s = ?" % (row[0], dict(OBJECT_TABLES)[row[0]]), row[1:])
+
+    def write(self, row, data):
+        if row[0] == "topic_words":
+            self.delete(row)
+            self.db.executemany("INSERT INTO topic_words (topic, level, position, word) VALUES (?, ?, ?, ?)",
+                                [(row[1], level, position, word) for level, levelwords in self.loads(data, None).iteritems()
+                                 for position, word in enumerate(levelwords)])
+        elif row[0] in ENTRY_TABLES:
+            self.db.execute("INSERT OR REPLACE INTO %s (nick, at, entry) VALUES (?, ?, ?)" % row[0],
+                            row[1:] + (sqlite3.Binary(data),))
+        else:
+            self.db.execute("INSERT OR REPLACE INTO %s (%s, state) VALUES (?, ?)" % (row[0], dict(OBJECT_TABLES)[row[0]]),
+                            (row[1], sqlite3.Binary(data)))
+
+class JournalStore(RowStore):
+    """
+    A snapshot of all rows in filename, and the rows changed since in
+    filename.journal. Every save appends its changes to the journal with a
+    single write and fsync. Once the journal has grown larger than the
+    snapshot, both are replaced by a new snapshot. Both files start with
+    the generation of the snapshot, so a journal left behind by a crash
+    while compacting isn't replayed over a newer snapshot.
+    """
+    commit_interval = 5 # Seconds between saves, so a crash loses at most this much
+    min_compact_size = 1 << 20 # Bytes of journal never worth compacting
+
+    def __init__(self, filename, classes):
+        RowStore.__init__(self, classes)
+        self.filename = filename
+        self.journalname = "%s.journal" % filename
+        self.generation = 0
+        self.snapshot_size = 0
+        self.journal = None
+        self.compactions = 0
+
+    @staticmethod
+    def remove(filename):
+        for name in (filename, "%s.journal" % filename):
+            if os.path.exists(name):
+                os.remove(name)
+
+    @staticmethod
+    def rename(filename, newname):
+        os.rename("%s.journal" % filename, "%s.journal" % newname)
+        os.rename(filename, newname)
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    @staticmethod
+    def record(value):
+        data = cPickle.dumps(value, 2)
+        return struct.pack(">I", len(data)) + data
+
+    def records(self, f):
+        """ Read records until the end of a file or a record cut off by a crash """
+        while True:
+            header = f.read(4)
+            if len(header) < 4:
+                return
+            length, = struct.unpack(">I", header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            try:
+                value = cPickle.loads(data)
+            except Exception:
+                return # Garbage written by a crash
+            yield value
+
+    def load(self):
+        with open(self.filename, "rb") as f:
+            f.readline()
+            self.generation, rows = next(self.records(f))
+        self.snapshot_size = os.path.getsize(self.filename)
+        replayed = 0
+        clean = True # Whether the journal can be appended to
+        if os.path.exists(self.journalname):
+            with open(self.journalname, "rb") as f:
+                f.readline()
+                records = self.records(f)
+                header = next(records, None)
+                clean = False
+                if header == self.generation:
+                    end = f.tell()
+                    for changed, removed in records:
+                        for row in removed:
+                            rows.pop(row, None)
+                        rows.update(changed)
+                        replayed += 1
+                        end = f.tell()
+                    # Records appended after a cut off one would never be replayed
+                    clean = end == os.fstat(f.fileno()).st_size
+        state = self.decode(rows)
+        # Start over with a snapshot of what was just loaded if there was a journal
+        if replayed:
+            self.compact(rows)
+        else:
+            self.open_journal(truncate=not clean)
+        return state
+
+    def open_journal(self, truncate):
+        self.close()
+        if truncate or not os.path.exists(self.journalname):
+            temporary = "%s.tmp" % self.journalname
+            with open(temporary, "wb") as f:
+                f.write(JOURNAL_HEADER)
+                f.write(self.record(self.generation))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(temporary, self.journalname)
+        self.journal = open(self.journalname, "ab")
+
+    def compact(self, rows):
+        """ Write all rows to a new snapshot, and start a new journal """
+        self.generation += 1
+        temporary = "%s.tmp" % self.filename
+        with open(temporary, "wb") as f:
+            f.write(JOURNAL_HEADER)
+            f.write(self.record((self.generation, rows)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temporary, self.filename)
+        self.snapshot_size = os.path.getsize(self.filename)
+        self.open_journal(truncate=True)
+        self.compactions += 1
+
+    def save(self, users, topics, channels, settings, dirty=None):
+        """
+        Append what changed since the last save to the journal, looking only
+        at the objects in dirty unless it is None. Returns the number of
+        objects written.
+        """
+        state = (users, topics, channels, settings)
+        changed, removed, objects = self.changes(state, dirty)
+        if not os.path.exists(self.filename):
+            # A new database
+            self.compact(dict(changed))
+            return objects
+        if not changed and not removed:
+            return 0
+        if self.journal is None:
+            self.open_journal(truncate=False)
+        self.journal.write(self.record((changed, removed)))
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        if self.journal.tell() > max(self.snapshot_size, self.min_compact_size):
+            self.compact(dict(self.encode(state)))
+        return objects
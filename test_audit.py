@@ -0,0 +1,186 @@
+# Copyright (c) 2013 Sylvia van Os
+# This file is part of Triggerbot, released under the MIT license
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# Checks that auditing many lines for many users at once (TriggerBot.audit
+# and triggerfilter.BulkFilter) gives the same verdicts as is_safe, both
+# with SciPy and with the set based fallback.
+# Run with: python -m unittest test_audit
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import xapian
+import triggerbot
+import triggerfilter
+
+SAFE = [True, None, None]
+
+class AuditTest(object):
+    """ The tests, mixed into a TestCase for each way BulkFilter can compute """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.bot = bot = triggerbot.TriggerBot()
+        bot.logger = triggerbot.MessageLogger(open(os.devnull, "w"))
+        bot.filename = os.path.join(self.directory, "triggerbot.db")
+        bot.fold = triggerfilter.FoldCache(1000)
+        bot.stem = triggerfilter.StemCache(xapian.Stem("en"))
+        bot.open_database()
+        self.add_topic("spiders", 1, "talk about spiders", ["spider", "web", "black widow"])
+        self.add_topic("spiders", 2, "talk about insects", ["bug", "/b[e3]{2}s?/"])
+        self.add_topic("panic", 1, "talk about panic attacks", ["panic attack", "hyperventilating"])
+
+    def tearDown(self):
+        self.bot.logger.file.close()
+        shutil.rmtree(self.directory)
+
+    def add_topic(self, name, level, description, words):
+        topic = self.bot.topics.get(name)
+        if topic is None:
+            topic = self.bot.topics[name] = triggerbot.Topic(name)
+        topic.descriptions[level] = description
+        topic.words[level] = [self.bot.trigger_term(word) for word in words]
+        self.bot.topic_changed(topic)
+        return topic
+
+    def make_user(self, nick, words=(), topics=()):
+        user = self.bot.get_user(nick)
+        user.trigger_words.update(self.bot.trigger_term(word) for word in words)
+        for name, level in topics:
+            user.topics[self.bot.find_topic(name)] = level
+        self.bot.triggers_changed(user)
+        return user
+
+    def assertSameVerdicts(self, messages, users):
+        """ Compare audit with is_safe, returns how many verdicts were unsafe """
+        audited = self.bot.audit(messages, users)
+        self.assertEqual(len(audited), len(messages))
+        unsafe = 0
+        for message, hidden in zip(messages, audited):
+            verdicts = dict(hidden)
+            self.assertEqual(len(verdicts), len(hidden), "%r is unsafe for a user twice" % message)
+            for user in users:
+                expected = self.bot.is_safe(message, user)
+                self.assertEqual(verdicts.get(user, SAFE), expected, "%r for %s" % (message, user))
+                if not expected[0]:
+                    unsafe += 1
+        self.assertTrue(0 < unsafe < len(messages) * len(users), "all verdicts were the same")
+        return unsafe
+
+    def test_words(self):
+        users = [self.make_user("cats", ["cat"]), self.make_user("dogs", ["dog", "leash"])]
+        self.assertSameVerdicts(["I have a cat", "Cats and dogs", "walking the dog on a leash",
+                                 "nothing to see here", "catalogue"], users)
+
+    def test_phrases(self):
+        users = [self.make_user("bites", ["dog bite"]), self.make_user("dogs", ["dog"])]
+        self.assertSameVerdicts(["the dog bit me", "a dog bite", "Dog bites man", "bite the dog",
+                                 "a bite"], users)
+
+    def test_patterns(self):
+        users = [self.make_user("phone", ["/[0-9]{3}-[0-9]{4}/"]), self.make_user("mixed", ["/colou?r/", "paint"])]
+        self.assertSameVerdicts(["call 555-1234", "call 5551234", "what colour is it", "what COLOR is it",
+                                 "paint it", "nothing here"], users)
+
+    def test_fuzzy(self):
+        self.bot.get_settings().fuzzydistance = 1
+        self.bot.trigger_index.vocabulary.set_fuzzy_distance(1)
+        self.bot.verdicts_changed()
+        users = [self.make_user("spiders", ["spider"]), self.make_user("panic", ["panic"])]
+        self.assertSameVerdicts(["a spidr", "a spyder", "a spider", "panik", "picnic", "hello"], users)
+
+    def test_topic_levels(self):
+        users = [self.make_user("one", topics=[("spiders", 1)]), self.make_user("two", topics=[("spiders", 2)]),
+                 self.make_user("both", ["cat"], [("spiders", 1), ("panic", 1)])]
+        self.assertSameVerdicts(["a spider web", "a black widow", "a bug", "b33s everywhere",
+                                 "I had a panic attack", "hyperventilating cat", "nothing here"], users)
+
+    def test_topic_detection(self):
+        self.bot.get_settings().topicdetection = True
+        topic = self.bot.find_topic("spiders")
+        topic.examples[1] = ["eight legs crawling on the wall"]
+        topic.threshold = 0.5
+        self.bot.index_topic(topic)
+        users = [self.make_user("one", topics=[("spiders", 1)]), self.make_user("cats", ["cat"])]
+        self.assertSameVerdicts(["eight legs crawling", "crawling on the wall with eight legs",
+                                 "my cat has four legs", "nothing here"], users)
+
+    def test_unknown_users(self):
+        """ Audit takes users the bot doesn't know, to try out triggers """
+        known = self.make_user("known", ["cat"])
+        sample = triggerbot.User("(sample)")
+        sample.topics[self.bot.find_topic("spiders")] = 1
+        audited = self.bot.audit(["a cat", "a spider", "a dog"], [known, sample])
+        self.assertEqual([[user for user, verdict in hidden] for hidden in audited], [[known], [sample], []])
+
+    def test_bulk_filter(self):
+        users = [self.make_user("u%d" % number, words, topics) for number, (words, topics) in enumerate([
+            (["cat"], []), (["dog bite"], [("panic", 1)]), (["/[0-9]{3}-[0-9]{4}/"], [("spiders", 2)]),
+            ([], [("spiders", 1)]), ([], [])])]
+        bulk = triggerfilter.BulkFilter([(user, self.bot.trigger_index.compile(user).reasons) for user in users])
+        messages = ["a cat", "a dog bite", "555-1234", "a bug", "a spider", "a panic attack", "nothing"]
+        detect = self.bot.get_settings().topicdetection
+        batch = [triggerfilter.match_all(self.bot.trigger_index.vocabulary, self.bot.topic_detector,
+                                         self.bot.tokenize(message), message, detect) for message in messages]
+        for message, unsafe in zip(messages, bulk.unsafe(batch)):
+            self.assertEqual(set(unsafe), set(user for user in users if not self.bot.is_safe(message, user)[0]),
+                             message)
+
+    def test_random_lines(self):
+        self.bot.get_settings().fuzzydistance = 1
+        self.bot.trigger_index.vocabulary.set_fuzzy_distance(1)
+        self.bot.verdicts_changed()
+        generator = random.Random(152)
+        entries = ["cat", "dog", "panic attack", "/[0-9]{3}-[0-9]{4}/", "legs", "spider"]
+        users = [self.make_user("u%d" % number, generator.sample(entries, 2),
+                                [("spiders", number % 3)] if number % 3 else [])
+                 for number in range(8)]
+        words = ["spider", "spidr", "web", "black", "widow", "bug", "bees", "b33", "cat", "cats", "dog",
+                 "panic", "attack", "legs", "hello", "555-1234", "the", "a"]
+        messages = [" ".join(generator.choice(words) for word in range(generator.randint(1, 6)))
+                    for message in range(300)]
+        self.assertSameVerdicts(messages, users)
+
+class SciPyAuditTest(AuditTest, unittest.TestCase):
+    """ BulkFilter multiplying sparse matrices """
+
+    def setUp(self):
+        if triggerfilter.numpy is None:
+            self.skipTest("NumPy and SciPy are not installed")
+        AuditTest.setUp(self)
+
+class SetAuditTest(AuditTest, unittest.TestCase):
+    """ BulkFilter using sets, as without NumPy and SciPy """
+
+    def setUp(self):
+        self.numpy = triggerfilter.numpy
+        triggerfilter.numpy = None
+        AuditTest.setUp(self)
+
+    def tearDown(self):
+        AuditTest.tearDown(self)
+        triggerfilter.numpy = self.numpy
+
+if __name__ == "__main__":
+    unittest.main()
@@ -43,7 +43,7 @@ For more information, please check the README.
 """
 
 from twisted.words.protocols import irc
-from twisted.internet import reactor, protocol, task
+from twisted.internet import reactor, protocol, task, defer, threads
 from twisted.python import log
 import time
 import datetime
@@ -51,10 +51,12 @@ import sys
 import re
 import random
 import os.path
-import cPickle
 import xapian
 import bcrypt
 import reloading
+import triggerfilter
+import filterpool
+import storage
 
 class UserError(Exception):
     pass
@@ -122,6 +124,31 @@ def join_and(delim, last_delim, items):
     else:
         return ""
 
+def group_phrases(params):
+    '''group_phrases(['"panic', 'attack"', 'spider']) == ["panic attack", "spider"]'''
+    entries = []
+    phrase = None
+    for param in params:
+        if phrase is None and param.startswith('"'):
+            phrase = []
+            param = param[1:]
+        if phrase is None:
+            entries.append(param)
+        elif param.endswith('"'):
+            phrase.append(param[:-1])
+            entries.append(" ".join(word for word in phrase if word))
+            phrase = None
+        else:
+            phrase.append(param)
+    if phrase:
+        # Unterminated quote, take the rest as the phrase
+        entries.append(" ".join(word for word in phrase if word))
+    return [entry for entry in entries if entry]
+
+def quote_phrase(entry):
+    '''Inverse of group_phrases for a single entry, used when exporting.'''
+    return '"%s"' % entry if " " in entry else entry
+
 def parse_bool(s):
     if s.lower() in ("y", "yes", "on", "enabled", "true"): return True
     elif s.lower() in ("n", "no", "off", "disabled", "false"): return False
@@ -142,10 +169,93 @@ class MessageLogger:
         self.file.write('%s %s\n' % (timestamp, message))
         self.file.flush()
 
+# A chat line as written to the log: "[12:34:56] [#channel] <nick> message"
+LOGGED_LINE = re.compile(r"^\[\d\d:\d\d:\d\d\] (\[[^\]]*\] (<[^>]*>|\* \S+) )?")
+
+def read_audit_lines(filename, logged_only=False):
+    """
+    Read the lines to audit from a file, which is either one message per
+    line, or a triggerbot log, of which only the chat lines are used.
+    With logged_only, lines which weren't logged by triggerbot are skipped.
+    """
+    lines = []
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.rstrip("\r\n")
+            logged = LOGGED_LINE.match(line)
+            if logged:
+                if not logged.group(1):
+                    continue # Something other than chat was logged
+                line = line[logged.end():]
+            elif logged_only:
+                continue
+            if line.strip():
+                lines.append(line)
+    return lines
+
+AUDIT_CHUNK = 200 # Lines audited at a time by admin topic coverage, between other events
+
+# IRCv3 capabilities triggerbot asks for
+CAPABILITIES = frozenset(["away-notify", "account-notify", "extended-join", "multi-prefix", "userhost-in-names"])
+# With these, the server tells us about away and login changes, so they don't need to be polled
+PRESENCE_CAPABILITIES = frozenset(["away-notify", "account-notify", "extended-join"])
+WHO_INTERVAL = 60.0 # Seconds in which every channel is checked once, when polling
+WHOX_TOKEN = "152" # Marks WHOX replies to our own queries
+
 def is_channel_name(name):
     return name[0] in irc.CHANNEL_PREFIXES
 
-class Setting(reloading.Reloadable):
+def split_channel_name(name):
+    """
+    Split a channel name into its base channel and owner, the latter being
+    None unless it's a triggersafe channel (#channel_nickname).
+    """
+    if name is None:
+        return None, None
+    parts = name.split("_")
+    return parts[0], parts[1] if len(parts) > 1 else None
+
+# Values which can't be changed in place, so assigning an equal one changes nothing
+IMMUTABLE_TYPES = (basestring, bool, int, long, float, type(None), tuple, frozenset, datetime.date, datetime.timedelta)
+
+class TransientState(object):
+    """
+    Mixin for saved classes. Attributes listed in 'transient' hold data
+    derived at runtime: they are not saved, and are reset to what
+    __init__ sets them to when loaded. Setting any other attribute to a
+    different value marks the object dirty, to be written on the next
+    save; changes inside its lists, sets and dictionaries are marked with
+    TriggerBot.changed.
+    """
+    transient = ()
+    dirty = False # Loaded objects start out clean
+
+    def __setattr__(self, name, value):
+        if name != "dirty" and not name in self.transient:
+            if not name in self.__dict__:
+                object.__setattr__(self, "dirty", True)
+            else:
+                current = self.__dict__[name]
+                # The same list, set or dictionary may have been changed in place
+                if current is value and not isinstance(value, IMMUTABLE_TYPES) or current != value:
+                    object.__setattr__(self, "dirty", True)
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("dirty", None)
+        for entry in self.transient:
+            state.pop(entry, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.transient:
+            defaults = self.__class__(None)
+            for entry in self.transient:
+                setattr(self, entry, getattr(defaults, entry))
+
+class Setting(reloading.Reloadable, TransientState):
     """Class containing bot settings."""
     is_setting = True
     def __init__(self, name):
@@ -154,15 +264,258 @@ class Setting(reloading.Reloadable):
         self.globalmotd = ""
         self.maindisabled = False
         self.disabledcommands = []
+        self.fuzzydistance = 0 # Allowed typos when matching trigger words
+        self.topicdetection = False # Also score messages against topic examples
+        self.rulesdelay = 2 # Seconds to gather changes before updating rules and topics
 
     def __str__(self):
         return self.name
 
-class Channel(reloading.Reloadable):
+class FamilyRules(object):
+    """
+    The trigger topics of everyone in a channel family, kept as reference
+    counted (topic, level) contributions, so the rules of its channels can
+    be updated as people come and go instead of recomputed.
+    """
+    def __init__(self):
+        self.memberships = {} # user -> number of channels of the family they are in
+        self.contributions = {} # user -> (master, {topic: level} counted for them)
+        self.masters = {} # master -> members counted on their behalf
+        self.counts = {} # topic -> {level: number of members contributing it}
+        self.rules = {} # topic -> highest level contributed
+        self.version = 0 # Bumped whenever the counts change
+        self.unchecked = set() # Members to check against blocked topics
+
+    def join(self, user):
+        """Count a membership. Returns True if the user is new to the family."""
+        count = self.memberships.get(user, 0)
+        self.memberships[user] = count + 1
+        return not count
+
+    def part(self, user):
+        """
+        Uncount a membership, dropping the user's contribution with their
+        last one. Returns the topics that changed.
+        """
+        count = self.memberships.pop(user) - 1
+        if count:
+            self.memberships[user] = count
+            return set()
+        return self.contribute(user, None, {})
+
+    def contribute(self, user, master, topics):
+        """
+        Set the {topic: level} a member contributes, or drop the member
+        when master is None. Returns the topics that changed.
+        """
+        oldmaster, old = self.contributions.pop(user, (None, {}))
+        if oldmaster is not None:
+            self.masters[oldmaster].discard(user)
+            if not self.masters[oldmaster]:
+                del self.masters[oldmaster]
+        if master is not None:
+            self.contributions[user] = (master, topics)
+            self.masters.setdefault(master, set()).add(user)
+        self.unchecked.discard(user)
+        changed = set()
+        for topic, level in old.iteritems():
+            if topics.get(topic) != level:
+                levels = self.counts[topic]
+                levels[level] -= 1
+                if not levels[level]:
+                    del levels[level]
+                    if not levels:
+                        del self.counts[topic]
+                changed.add(topic)
+        for topic, level in topics.iteritems():
+            if old.get(topic) != level:
+                levels = self.counts.setdefault(topic, {})
+                levels[level] = levels.get(level, 0) + 1
+                changed.add(topic)
+        if changed:
+            self.version += 1
+            for topic in changed:
+                if topic in self.counts:
+                    self.rules[topic] = max(self.counts[topic])
+                else:
+                    self.rules.pop(topic, None)
+            if any(topic in topics for topic in changed):
+                self.unchecked.add(user)
+        return changed
+
+    def rules_without(self, master):
+        """The rules as they would be without a master and their alts."""
+        members = self.masters.get(master)
+        if not members:
+            return self.rules
+        counts = {}
+        for member in members:
+            for topic, level in self.contributions[member][1].iteritems():
+                counts.setdefault(topic, dict(self.counts[topic]))[level] -= 1
+        rules = dict(self.rules)
+        for topic, levels in counts.iteritems():
+            levels = [level for level, count in levels.iteritems() if count]
+            if levels:
+                rules[topic] = max(levels)
+            else:
+                del rules[topic]
+        return rules
+
+class MembershipIndex(object):
+    """Which channels, and which channel families, every user is in."""
+    def __init__(self):
+        self.channels = {} # user -> set of channels
+        self.families = {} # user -> {base channel name: number of channels of the family the user is in}
+
+    def add(self, channel, user):
+        channels = self.channels.setdefault(user, set())
+        if channel in channels:
+            return
+        channels.add(channel)
+        families = self.families.setdefault(user, {})
+        basename = channel.base
+        families[basename] = families.get(basename, 0) + 1
+
+    def remove(self, channel, user):
+        channels = self.channels.get(user)
+        if not channels or channel not in channels:
+            return
+        channels.remove(channel)
+        families = self.families[user]
+        basename = channel.base
+        families[basename] -= 1
+        if not families[basename]:
+            del families[basename]
+        if not channels:
+            del self.channels[user]
+            del self.families[user]
+
+    def channels_of(self, user):
+        return self.channels.get(user, ())
+
+    def families_of(self, user):
+        """Names of the base channels of the families the user is in."""
+        return self.families.get(user, {}).keys()
+
+RULES_MAX_STALENESS = 30 # Seconds a channel's rules and topic may lag behind at most
+
+class Coalescer(object):
+    """
+    Gathers keys marked dirty and updates each of them once, after no new
+    marks came in for that key for delay seconds, but never later than
+    max_staleness seconds after its first mark. With no delay, updates
+    right away.
+    """
+    def __init__(self, update, delay, max_staleness=RULES_MAX_STALENESS):
+        self.update = update
+        self.delay = delay
+        self.max_staleness = max_staleness
+        self.pending = {} # key -> [delayed call, deadline]
+        self.marks = 0
+        self.runs = 0
+        self.forced = 0 # Flushes which had to be done because of max_staleness
+
+    def mark(self, key):
+        self.marks += 1
+        if not self.delay:
+            self.runs += 1
+            self.update(key)
+            return
+        now = reactor.seconds()
+        pending = self.pending.get(key)
+        if pending is None:
+            self.pending[key] = [reactor.callLater(self.delay, self.flush, key),
+                                 now + max(self.delay, self.max_staleness)]
+        else:
+            call, deadline = pending
+            call.reset(max(min(self.delay, deadline - now), 0))
+
+    def flush(self, key=None):
+        """ Update a key now if it is dirty, or all dirty keys """
+        if key is None:
+            for key in self.pending.keys():
+                self.flush(key)
+            return
+        pending = self.pending.pop(key, None)
+        if pending is None:
+            return
+        call, deadline = pending
+        if call.active():
+            call.cancel() # Flushed early
+        elif reactor.seconds() >= deadline:
+            self.forced += 1
+        self.runs += 1
+        self.update(key)
+
+    def cancel(self):
+        for call, deadline in self.pending.itervalues():
+            if call.active():
+                call.cancel()
+        self.pending.clear()
+
+    def stats(self):
+        return "%d requested, %d done (%d coalesced), %d forced by the %d second staleness bound" % (
+            self.marks, self.runs, self.marks - self.runs - len(self.pending), self.forced, self.max_staleness)
+
+class TopicTemplate(object):
+    """
+    A channel's topicset, parsed once into literal text and [field]
+    placeholders. Fields are only formatted again when their value changed.
+    """
+    placeholder = re.compile(r"\[([^\[\]]*)\]")
+
+    def __init__(self, text):
+        self.text = text
+        self.segments = [] # Literal text, or None where a field goes
+        self.fields = [] # The field of every placeholder, in order
+        position = 0
+        for match in self.placeholder.finditer(text):
+            self.segments.append(text[position:match.start()])
+            self.segments.append(None)
+            self.fields.append(match.group(1))
+            position = match.end()
+        self.segments.append(text[position:])
+        self.values = {} # field -> (value, formatted text)
+
+    def format(self, field, value):
+        if not value or isinstance(value, set):
+            return "" # Not filled in
+        if not isinstance(value, str):
+            value = " ".join(value)
+        if field == "globalmotd":
+            if not value.startswith("MOTD:"):
+                value = "MOTD: %s" % value
+        elif not value.startswith("Current %s:" % field):
+            value = "Current %s: %s" % (field, value)
+        return "%s | " % value
+
+    def render(self, values):
+        """ Fill in {field: value}, leaving out the last separator """
+        fields = iter(self.fields)
+        text = []
+        for segment in self.segments:
+            if segment is None:
+                field = next(fields)
+                value = values.get(field)
+                if isinstance(value, list):
+                    value = tuple(value)
+                cached = self.values.get(field)
+                if cached is None or cached[0] != value:
+                    cached = self.values[field] = (value, self.format(field, value))
+                segment = cached[1]
+            text.append(segment)
+        return " | ".join("".join(text).split(" | ")[:-1]).lstrip()
+
+class Channel(reloading.Reloadable, TransientState):
     """Information about a channel the bot is in."""
     is_channel = True
+    transient = ("forbidden", "member_terms", "pattern_matcher", "verdict_version", "family_rules", "rules_key",
+                 "topic_template", "topic_sent", "rules_version", "rules_text", "awake_members",
+                 "base", "owner", "owner_nick")
     def __init__(self, name):
         self.name = name
+        self.base, self.owner = split_channel_name(name) # Parsed from name
+        self.owner_nick = None # The owner's nick as found by channel_owner
         self.admins = []
         self.users = set()
         self.rules = {}
@@ -171,11 +524,28 @@ class Channel(reloading.Reloadable):
         self.mode = []
         self.prevmode = []
         self.blockedtopics = {}
+        # Trigger terms of the users present (triggersafe channels only)
+        self.forbidden = {} # term -> set of users having it
+        self.member_terms = {} # user -> terms the user added to forbidden
+        # Patterns present in the whole channel family (base channels only)
+        self.pattern_matcher = None # Compiled lazily by family_patterns
+        self.verdict_version = 0 # Bumped when cached verdicts of the family are outdated
+        self.family_rules = FamilyRules() # Topics of everyone in the family (base channels only)
+        self.rules_key = None # What the rules and topic were last derived from
+        self.topic_template = None # topicset, compiled by update_topic
+        self.topic_sent = None # The topic as last sent by update_topic, unless the server refused it
+        self.rules_version = 0 # Bumped whenever rules changes
+        self.rules_text = None # (what it was rendered from, rules as rendered by report_rules)
+        self.awake_members = 0 # Members who aren't away, not counting services or the bot (autosilence)
 
     def __str__(self):
         return self.name
 
-class User(reloading.Reloadable):
+    def __setstate__(self, state):
+        TransientState.__setstate__(self, state)
+        self.base, self.owner = split_channel_name(self.name)
+
+class User(reloading.Reloadable, TransientState):
     """Information about a user."""
     is_user = True
     def __init__(self, nick):
@@ -220,13 +590,15 @@ class User(reloading.Reloadable):
     def __repr__(self):
         return self.nick
 
-class Topic(reloading.Reloadable):
+class Topic(reloading.Reloadable, TransientState):
     """Information about a trigger topic."""
     def __init__(self, name):
         self.name = name
         self.descriptions = {}
         self.words = {}
         self.supersedes = []
+        self.examples = {} # level -> example sentences, for topic detection
+        self.threshold = None # Minimum topic detection score, None to disable
 
 class TimeFormat():
     """Formats dates. Based S Anand's py-pretty code licensed under the WTFPL"""
@@ -274,6 +646,9 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
     """Main TriggerBot code."""
 
     bot_commands = {}
+    filter_pool = None # Set by the factory when running with --workers
+    storage = None # Kind of database (--storage), None to go by the file
+    bgsave = False # Save pickles from a forked child (--bgsave)
 
     @classmethod
     def add_command(cls, description=None):
@@ -376,8 +751,45 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         if channel is None:
             channel = Channel(name.lower())
             self.channels[channel.name] = channel
+            self.topology_add(channel)
         return channel
 
+    def topology_add(self, channel):
+        """Add a channel to the base channel -> triggersafe channels map."""
+        children = self.triggersafe.setdefault(channel.base, set())
+        if channel.owner is not None:
+            children.add(channel)
+
+    def topology_remove(self, channel):
+        children = self.triggersafe.get(channel.base)
+        if children is None:
+            return
+        children.discard(channel)
+        if not children and not channel.base in self.channels:
+            del self.triggersafe[channel.base]
+
+    def triggersafe_channels(self, basename):
+        """The triggersafe channels of a base channel."""
+        return self.triggersafe.get(basename, ())
+
+    def channel_family(self, basename):
+        """A base channel (if the bot has it) and its triggersafe channels."""
+        family = list(self.triggersafe.get(basename, ()))
+        if basename in self.channels:
+            family.insert(0, self.channels[basename])
+        return family
+
+    def base_channels(self):
+        return [self.channels[name] for name in self.triggersafe if name in self.channels]
+
+    def channel_owner(self, channel):
+        """The master of the owner of a triggersafe channel, or None for a base channel."""
+        if channel.owner is None:
+            return None
+        if channel.owner_nick is None or not channel.owner_nick in self.users:
+            channel.owner_nick = self.get_channel_owner(channel.owner)
+        return self.check_for_master(self.get_user(channel.owner_nick))
+
     def get_channel_owner(self, name):
         for user in self.users:
             if user.lower() == name:
@@ -410,21 +822,219 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         settings = self.settings.get("triggerbot")
         return settings
 
-    def changed(self):
+    def changed(self, *objects):
+        """
+        Mark users, topics, channels or settings as changed, for changes
+        which setting an attribute doesn't mark, or removed from the
+        database. Without any, everything is written on the next save.
+        """
         self.__dirty = True
+        if objects:
+            for obj in objects:
+                obj.dirty = True
+        else:
+            self.__everything = True
 
     def save(self):
-        if self.__dirty:
-            with open(self.filename, "w") as f:
-                cPickle.dump((self.users, self.topics, self.channels, self.settings), f)
-            self.__dirty = False
-            self.logger.log("Saved state.")
+        dirty = [obj for objects in (self.users, self.topics, self.channels, self.settings)
+                 for obj in objects.itervalues() if obj.dirty]
+        if self.__dirty or dirty:
+            started = time.time()
+            written = self.store.save(self.users, self.topics, self.channels, self.settings,
+                                      None if self.__everything else dirty)
+            self.last_save = (written, time.time() - started)
+            self.saves += 1
+            for obj in dirty:
+                obj.dirty = False
+            self.__dirty = self.__everything = False
+            self.logger.log("Saved state: %d object(s) written in %.2f ms." % (written, self.last_save[1] * 1000))
 
     def load(self):
-        with open(self.filename, "r") as f:
-            self.users, self.topics, self.channels, self.settings = cPickle.load(f)
-        self.__dirty = False
+        self.users, self.topics, self.channels, self.settings = self.store.load()
+        self.__dirty = self.__everything = False
         self.check_database()
+        self.trigger_index.vocabulary.set_fuzzy_distance(self.get_settings().fuzzydistance)
+        self.trigger_index.rebuild(self.users.itervalues())
+        for topic in self.topics.itervalues():
+            self.index_topic(topic)
+        for channel in self.channels.values():
+            self.topology_add(channel)
+            channel.forbidden = {}
+            channel.member_terms = {}
+            channel.awake_members = 0
+            for user in channel.users:
+                self.memberships.add(channel, user)
+                self.view_add(channel, user)
+                self.family_join(channel, user)
+                if self.is_awake(user):
+                    channel.awake_members += 1
+
+    def triggers_changed(self, user):
+        """Called whenever a user's trigger topics or words change."""
+        self.trigger_index.update_user(user)
+        self.refresh_views([user])
+        self.refresh_rules([user])
+        self.verdicts_changed()
+
+    def topic_changed(self, topic):
+        """Called whenever the words of a trigger topic change."""
+        users = self.trigger_index.topic_changed(topic.name)
+        for user in users:
+            self.trigger_index.profile(user)
+        self.refresh_views(users)
+        self.index_topic(topic)
+
+    def index_topic(self, topic):
+        """ (Re-)index a topic's levels for probabilistic topic detection """
+        levels = {}
+        for level in set(topic.words) | set(topic.descriptions) | set(topic.examples):
+            terms = []
+            for word in topic.words.get(level, ()):
+                if not triggerfilter.is_pattern(word):
+                    terms.extend(word.split(" "))
+            for text in [topic.descriptions.get(level, "")] + topic.examples.get(level, []):
+                terms.extend(term for word, term in self.tokenize(text))
+            levels[level] = terms
+        self.topic_detector.update_topic(topic.name, levels, topic.threshold)
+        self.verdicts_changed()
+
+    def detected_topics(self, tokens):
+        """ Matched terms for the topic levels a message was scored to be about """
+        if not self.get_settings().topicdetection:
+            return []
+        matched = []
+        for name, level in self.topic_detector.detect(term for word, term in tokens):
+            term = triggerfilter.topic_term(name, level)
+            if term in self.trigger_index.postings:
+                matched.append((name, term))
+        return matched
+
+    def add_member(self, channel, user):
+        """Add a user to a channel's user list."""
+        if not user in channel.users:
+            channel.users.add(user)
+            self.changed(channel)
+            self.memberships.add(channel, user)
+            if self.is_awake(user):
+                channel.awake_members += 1
+            self.view_add(channel, user)
+            self.family_join(channel, user)
+            self.verdicts_changed(channel)
+
+    def remove_member(self, channel, user):
+        """Remove a user from a channel's user list. Raises KeyError if they're not there."""
+        channel.users.remove(user)
+        self.changed(channel)
+        self.memberships.remove(channel, user)
+        if self.is_awake(user):
+            channel.awake_members -= 1
+        self.view_remove(channel, user)
+        basechannel = self.get_channel(channel.base)
+        if basechannel.family_rules.part(user):
+            self.rules_dirty(basechannel)
+        self.verdicts_changed(channel)
+
+    def is_awake(self, user):
+        """Whether a user counts towards the awake members of their channels."""
+        return not user.away and not user.nick in ["ChanServ", "NickServ", self.nickname]
+
+    def mark_away(self, user, away):
+        """Set a user's away flag, keeping the awake members count of their channels right. Returns whether it changed."""
+        if away == user.away:
+            return False
+        counted = self.is_awake(user)
+        user.away = away
+        if counted != self.is_awake(user):
+            for channel in self.memberships.channels_of(user):
+                channel.awake_members += -1 if away else 1
+        return True
+
+    def family_join(self, channel, user):
+        """Count a new member of a channel towards the rules of its family."""
+        basechannel = self.get_channel(channel.base)
+        if basechannel.family_rules.join(user):
+            self.update_contribution(basechannel, user)
+
+    def update_contribution(self, basechannel, user):
+        """Recount the topics a member contributes to the rules of a family."""
+        master = self.check_for_master(user)
+        if user.away and master.awaycheck:
+            topics = {}
+        else:
+            topics = dict(master.topics)
+        if basechannel.family_rules.contribute(user, master, topics):
+            self.rules_dirty(basechannel)
+
+    def refresh_rules(self, users):
+        """Recount the rules contributions of these users and their alts, wherever they are."""
+        basenames = set()
+        for user in users:
+            basenames.update(self.memberships.families_of(user))
+            for alt in user.alts:
+                alt = self.users.get(alt)
+                if alt is not None:
+                    basenames.update(self.memberships.families_of(alt))
+        for basename in basenames:
+            basechannel = self.get_channel(basename)
+            family = basechannel.family_rules
+            members = {user for user in users if user in family.memberships}
+            for user in users:
+                members.update(family.masters.get(user, ()))
+            for member in members:
+                self.update_contribution(basechannel, member)
+
+    def verdicts_changed(self, channel=None):
+        """
+        Called whenever something relay_safe's verdicts depend on changes,
+        to outdate the cached verdicts of a channel's family, or of all
+        channels if none is given.
+        """
+        if channel is None:
+            self.verdict_version += 1
+        else:
+            self.get_channel(channel.base).verdict_version += 1
+
+    def view_add(self, channel, user):
+        """Add a member's trigger terms to the channel's forbidden terms."""
+        if channel.owner is None:
+            return
+        terms = self.trigger_index.profile(self.check_for_master(user)).terms
+        if terms:
+            channel.member_terms[user] = terms
+            for term in terms:
+                members = channel.forbidden.setdefault(term, set())
+                if not members and triggerfilter.is_pattern(term):
+                    self.get_channel(channel.base).pattern_matcher = None
+                members.add(user)
+
+    def view_remove(self, channel, user):
+        for term in channel.member_terms.pop(user, ()):
+            members = channel.forbidden.get(term)
+            if members is not None:
+                members.discard(user)
+                if not members:
+                    del channel.forbidden[term]
+                    if triggerfilter.is_pattern(term):
+                        self.get_channel(channel.base).pattern_matcher = None
+
+    def family_patterns(self, basechannel):
+        """ The compiled /pattern/ triggers of everyone in a channel family """
+        if basechannel.pattern_matcher is None:
+            patterns = {term for channel in self.triggersafe_channels(basechannel.name)
+                        for term in channel.forbidden if triggerfilter.is_pattern(term)}
+            basechannel.pattern_matcher = self.trigger_index.vocabulary.pattern_matcher(patterns)
+        return basechannel.pattern_matcher
+
+    def refresh_views(self, masters):
+        """Recompute the forbidden terms contributed by these users and their alts."""
+        members = set(masters)
+        for master in masters:
+            members.update(self.users[alt] for alt in master.alts if alt in self.users)
+        for member in members:
+            for channel in self.memberships.channels_of(member):
+                self.view_remove(channel, member)
+                self.view_add(channel, member)
+        self.verdicts_changed()
 
     def check_database(self, recipient=None, user_executed=None):
         # Make sure the settings are okay
@@ -432,14 +1042,14 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         for entry in database_values:
             if not hasattr(self.get_settings(), entry):
                 setattr(self.get_settings(), entry, getattr(Setting(None), entry))
-                self.changed()
+                self.changed(self.get_settings())
         # Make sure users are okay
         database_values = User(None).__dict__
         for user in self.users.itervalues():
             for entry in database_values:
                 if not hasattr(user, entry):
                     setattr(user, entry, getattr(User(None), entry))
-                    self.changed()
+                    self.changed(user)
         deletelist = []
         for entry in self.users:
             if entry != repr(self.users.get(entry)):
@@ -451,9 +1061,7 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                             % (entry, repr(self.users.get(entry))))
                 deletelist.append(entry)
         for entry in deletelist:
-            del self.users[entry]
-        if deletelist:
-            self.changed()
+            self.changed(self.users.pop(entry))
         # Check if there is only one head admin
         headadmincount = 0
         for user in self.users.itervalues():
@@ -482,14 +1090,32 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             for entry in database_values:
                 if not hasattr(topic, entry):
                     setattr(topic, entry, getattr(Topic(None), entry))
-                    self.changed()
+                    self.changed(topic)
+        # Make sure stored trigger terms are folded like incoming messages
+        for user in self.users.itervalues():
+            folded = set(self.fold_term(word) for word in user.trigger_words)
+            folded.discard("")
+            if folded != user.trigger_words:
+                user.trigger_words = folded
+                self.changed(user)
+        for topic in self.topics.itervalues():
+            for level, words in topic.words.iteritems():
+                folded = []
+                for word in words:
+                    word = self.fold_term(word)
+                    if word and not word in folded:
+                        folded.append(word)
+                if folded != words:
+                    topic.words[level] = folded
+                    self.changed(topic)
         # Make sure the channels are okay
         database_values = Channel(None).__dict__
         for channel in self.channels.itervalues():
             for entry in database_values:
                 if not hasattr(channel, entry):
                     setattr(channel, entry, getattr(Channel(None), entry))
-                    self.changed()
+                    self.changed(channel)
+            channel.base, channel.owner = split_channel_name(channel.name)
 
     def check_for_master(self, name):
         if name.master:
@@ -501,8 +1127,10 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         chan = self.get_channel(name)
         if not chan.name in self.get_settings().channels:
             self.get_settings().channels.append(chan.name)
-            self.changed()
-        chan.users = set()
+            self.changed(self.get_settings())
+        for user in list(chan.users):
+            self.remove_member(chan, user)
+        self.verdicts_changed(chan)
         # Register the channel
         self.msg('Chanserv',
             'REGISTER %s' % name)
@@ -533,76 +1161,96 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         chan = self.get_channel(name)
         if chan.name in self.get_settings().channels:
             self.get_settings().channels.remove(chan.name)
-            self.changed()
+            self.changed(self.get_settings())
         if chan.name in self.channels.keys():
+            for user in list(chan.users):
+                self.remove_member(chan, user)
             del self.channels[chan.name]
+            self.topology_remove(chan)
+            self.changed(chan)
+            self.verdicts_changed(chan)
             self.leave(chan.name)
         if unregister:
             # Unregister the channel
             self.msg('Chanserv',
                 'DROP %s' % name)
 
+    def rules_dirty(self, channel=None):
+        """ Update the rules and topics of a channel's family, or of all channels, soon """
+        if channel is None:
+            names = self.channels.keys()
+        else:
+            names = [familychannel.name for familychannel in self.channel_family(channel.base)]
+        for name in names:
+            self.rules_scheduler.mark(name)
+
+    def flush_rules(self, name):
+        channel = self.channels.get(name)
+        if channel is not None: # Not left in the meantime
+            self.update_rules(channel=channel)
+
     def update_rules(self, channel=None, report=True, changed=False):
         if channel is None:
-            for channel in self.channels.itervalues():
+            for channel in self.channels.values():
                 assert channel is not None
                 self.update_rules(channel=channel, report=report, changed=changed)
         else:
-            basechannel = str(channel).split("_")[0]
-            try:
-                if str(channel).split("_")[1]:
-                    triggersafechannel = True
-            except IndexError:
-                triggersafechannel = False
-            new_rules = {}
-            users = []
-            for channeltocheck in self.channels:
-                if channeltocheck.split("_")[0] == basechannel:
-                    for user in self.get_channel(channeltocheck).users:
-                        if user not in users:
-                            users.append(user)
-            try:
-                channelowner = self.check_for_master(self.get_user(self.get_channel_owner(str(channel).split("_")[1])))
-            except IndexError:
-                channelowner = None
-            for user in users:
-                master = self.check_for_master(user)
-                if master == channelowner and channelowner and channelowner.hideown:
-                    # Channel owner wants own triggers hidden in rules. Hide it.
-                    continue
-                if not (user.away and master.awaycheck):
-                    for topic, level in master.topics.iteritems():
-                        # If a channel does not allow this topic, kick the user out
-                        try:
-                            if self.get_channel(basechannel).blockedtopics[topic.name] <= level:
-                                self.dispatch(command="channel kick %s The topic you have set is not allowed in this channel" % user, user=user, reply_to=channel, bypass=True)
-                        except KeyError:
-                            pass
-                        new_rules[topic] = max(new_rules.get(topic, 0), level)
-            if new_rules != channel.rules or (channelowner and channel.prevmode != channel.mode and not ("silent" in channel.prevmode == "silent" in channel.mode)):
-                channel.rules = new_rules
-                changed = True
-            if report:
-                self.report_rules(channel=channel, changed=changed)
+            basechannel = self.get_channel(channel.base)
+            family = basechannel.family_rules
+            # If a channel does not allow a topic someone new has, kick them out
+            while family.unchecked:
+                user = family.unchecked.pop()
+                for topic, level in family.contributions[user][1].iteritems():
+                    if basechannel.blockedtopics.get(topic.name, level + 1) <= level:
+                        self.dispatch(command="channel kick %s The topic you have set is not allowed in this channel" % user, user=user, reply_to=channel, bypass=True)
+                        break
+            channelowner = self.channel_owner(channel)
+            # Channel owner may want own triggers hidden in rules
+            hidden = channelowner if channelowner and channelowner.hideown else None
+            key = (family.version, hidden, bool(channelowner and channelowner.topics), channel.topicset,
+                   self.get_settings().globalmotd, tuple(channel.mode), self.rules_wording_version)
+            if key != channel.rules_key or changed:
+                if channel.rules_key is None or key[0] != channel.rules_key[0] or key[1] != channel.rules_key[1]:
+                    new_rules = family.rules_without(hidden) if hidden else family.rules
+                    if new_rules != channel.rules:
+                        channel.rules = dict(new_rules)
+                        channel.rules_version += 1
+                        changed = True
+                if channelowner and channel.prevmode != channel.mode and not ("silent" in channel.prevmode == "silent" in channel.mode):
+                    changed = True
+                # Only rewrite the topic if something in it may have changed
+                if report:
+                    self.report_rules(channel=channel, changed=changed)
+                channel.rules_key = key
             channel.prevmode = channel.mode[:]
 
     def report_rules(self, channel, user=None, recipient=None, report_if_empty=True, changed=False):
         if not is_channel_name(str(channel)):
             return
-        try:
-            channelowner = self.check_for_master(self.get_user(self.get_channel_owner(str(channel).split("_")[1])))
-        except IndexError:
-            channelowner = None
+        if not channel.rules and not report_if_empty:
+            return
+        channelowner = self.channel_owner(channel)
+        # The owner's profile is replaced whenever their topics change
+        hidden = self.trigger_index.profile(channelowner) if channelowner and channelowner.hideown else None
+        key = (channel.rules_version, self.rules_wording_version, hidden,
+               bool(hidden is not None and channelowner.topics and not "silent" in channel.mode))
+        if channel.rules_text is None or channel.rules_text[0] != key:
+            channel.rules_text = (key, self.render_rules(channel, channelowner))
+        rules = channel.rules_text[1]
+        self.update_topic(channel=channel, replace={"rules": rules})
+        if changed:
+            self.send_and_log(recipient or user or channel, user, rules)
+
+    def render_rules(self, channel, channelowner):
         norulesbesidesownstring = "There are currently no additional rules besides yours"
         if channel.rules:
             previousDescription = ""
             descriptions = []
             rules = {}
-            topicssuperseded = []
+            topicssuperseded = set()
             othershiddencount = 0
             for topic, level in channel.rules.iteritems():
-                for entry in topic.supersedes:
-                    topicssuperseded.append(entry)
+                topicssuperseded.update(self.superseded.get(topic.name, topic.supersedes))
             for topic, level in channel.rules.iteritems():
                 if not topic.name in topicssuperseded:
                     if channelowner and channelowner.hideown and topic in channelowner.topics:
@@ -630,72 +1278,154 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                         % (othershiddencount, ("(s)"
                         if othershiddencount >= 2 else "")))
                         if othershiddencount >= 1 else "")
-            self.update_topic(channel=channel, replace={"rules": rules})
-            if changed:
-                self.send_and_log(recipient or user or channel, user, rules)
-        elif report_if_empty == True:
-            if channelowner and channelowner.topics and channelowner.hideown and not "silent" in channel.mode:
-                rules = "%s." % norulesbesidesownstring
-            else:
-                rules = "There are currently no additional rules."
-            self.update_topic(channel=channel, replace={"rules": rules})
-            if changed:
-                self.send_and_log(recipient or user or channel, user,
-                    rules)
+        elif channelowner and channelowner.topics and channelowner.hideown and not "silent" in channel.mode:
+            rules = "%s." % norulesbesidesownstring
+        else:
+            rules = "There are currently no additional rules."
+        return rules
+
+    def rules_wording_changed(self):
+        """
+        Called whenever topic descriptions or supersedes change, to
+        outdate rendered rules and update them in every channel soon.
+        """
+        self.update_superseded()
+        self.rules_wording_version += 1
+        self.rules_dirty()
+
+    def update_superseded(self):
+        """ Precompute which topics every topic supersedes, directly or through the topics it supersedes """
+        self.superseded = {}
+        for name, topic in self.topics.iteritems():
+            superseded = set()
+            pending = list(topic.supersedes)
+            while pending:
+                entry = pending.pop()
+                if not entry in superseded:
+                    superseded.add(entry)
+                    if entry in self.topics:
+                        pending.extend(self.topics[entry].supersedes)
+            superseded.discard(name)
+            self.superseded[name] = frozenset(superseded)
 
     def update_topic(self, channel, text=None, replace={}):
         if not text:
             text = channel.topicset
         if text:
-            replace['globalmotd'] = self.get_settings().globalmotd
-            self.topic(str(channel))
-            for entry in channel.__dict__.keys():
-                if not entry in replace.keys():
-                    replace[entry] = getattr(channel, entry)
-            for entry in replace.keys():
-                if replace[entry]:
-                    if isinstance(replace[entry], set):
-                        continue # What the hell should I do with sets?
-                    elif not isinstance(replace[entry], str):
-                        replace[entry] = " ".join(replace[entry])
-                    if entry == "globalmotd" and not replace[entry].startswith("MOTD:"):
-                        replace[entry] = "MOTD: %s" % replace[entry]
-                    elif not replace[entry].startswith("Current %s:" % entry):
-                        replace[entry] = "Current %s: %s" % (entry, replace[entry])
-                    if text.find("[%s]" % entry) != -1:
-                        text = text.split("[%s]" % entry)[0] + "%s | " % replace[entry] + text.split("[%s]" % entry)[1]
-            # Get rid of things we didn't fill in
-            while text.find("[") != -1 and text.find("]") != -1:
-                text = text.split("[")[0] + text.split("]")[1]
-            # Last cleanups
-            text = " | ".join(text.split(" | ")[:-1]).lstrip()
-            if getattr(channel, "topic") != text[:self.supported.getFeature("TOPICLEN")]:
-                self.topic(str(channel), text)
+            if channel.topic_template is None or channel.topic_template.text != text:
+                channel.topic_template = TopicTemplate(text)
+            values = {}
+            for field in channel.topic_template.fields:
+                if field in replace:
+                    values[field] = replace[field]
+                elif field == "globalmotd":
+                    values[field] = self.get_settings().globalmotd
+                elif not field in channel.transient: # Runtime state, never part of a topic
+                    values[field] = getattr(channel, field, None)
+            text = channel.topic_template.render(values)[:self.supported.getFeature("TOPICLEN")]
+            if text != channel.topic_sent:
+                channel.topic_sent = text
+                if text != channel.topic:
+                    self.topic(str(channel), text)
 
     def connectionMade(self):
+        self.caps_available = set()
+        self.caps = set() # Capabilities the server agreed to
+        self.who_calls = [] # WHO queries waiting for their turn
+        self.who_batch = {} # user -> (flags, account) from WHO replies not applied yet
         irc.IRCClient.connectionMade(self)
         self.logger.log("[connected at %s]" %
                         time.asctime(time.localtime(time.time())))
 
-        self.__dirty = False
+        self.open_database()
+        if self.filter_pool is not None:
+            self.filter_pool.attach(self.trigger_index.vocabulary, self.topic_detector)
+
+    def open_database(self):
+        """ Set up the bot's state, from the database if there is one """
+        self.__dirty = self.__everything = False
+        self.saves = 0
+        self.last_save = None # (objects written, seconds taken)
         self.channels = {}
         self.users = {}
         self.topics = {}
         self.settings = {"triggerbot": Setting("triggerbot")}
-        if os.path.exists(self.filename):
+        self.trigger_index = triggerfilter.TriggerIndex()
+        self.topic_detector = triggerfilter.TopicDetector()
+        self.verdict_cache = triggerfilter.LRUCache(1000)
+        self.verdict_version = 0
+        self.memberships = MembershipIndex()
+        self.triggersafe = {} # base channel name -> its triggersafe channels
+        # Changes made while loading are gathered until after connecting
+        self.rules_scheduler = Coalescer(self.flush_rules, Setting(None).rulesdelay)
+        self.rules_wording_version = 0
+        self.superseded = {}
+        self.store = storage.open_store(self.filename, self.storage,
+            {"users": User, "topics": Topic, "channels": Channel, "settings": Setting},
+            background=self.bgsave, log=self.logger.log)
+        if self.store.exists():
             self.load()
         else:
             print "WARNING: No administrator was found. Please use !claimadmin to claim administrator rights."
+        self.rules_scheduler.delay = self.get_settings().rulesdelay
+        self.update_superseded()
 
     def connectionLost(self, reason):
         irc.IRCClient.connectionLost(self, reason)
+        self.rules_scheduler.cancel()
+        for call in self.who_calls:
+            if call.active():
+                call.cancel()
+        for loop in (getattr(self, "check_away_loop", None), getattr(self, "commit_loop", None)):
+            if loop is not None and loop.running:
+                loop.stop()
         for user in self.users:
             self.find_user(user).logged_in = False
-        self.__dirty = True
+        self.changed()
         self.save()
+        self.store.close()
         self.logger.log("[disconnected at %s]" %
                         time.asctime(time.localtime(time.time())))
 
+    def register(self, nickname, hostname='foo', servername='bar'):
+        # Servers supporting capability negotiation wait for CAP END to finish registration
+        self.sendLine("CAP LS 302")
+        irc.IRCClient.register(self, nickname, hostname, servername)
+
+    def irc_CAP(self, prefix, params):
+        subcommand = params[1]
+        if subcommand == "LS":
+            self.caps_available.update(cap.split("=")[0] for cap in params[-1].split())
+            if params[2] == "*":
+                return # More to come
+            wanted = CAPABILITIES & self.caps_available
+            if wanted:
+                self.sendLine("CAP REQ :%s" % " ".join(sorted(wanted)))
+            else:
+                self.sendLine("CAP END")
+        elif subcommand == "ACK":
+            for cap in params[-1].split():
+                if cap.startswith("-"):
+                    self.caps.discard(cap[1:])
+                else:
+                    self.caps.add(cap.lstrip("~="))
+            self.sendLine("CAP END")
+        elif subcommand == "NAK":
+            self.sendLine("CAP END")
+        elif subcommand == "NEW":
+            self.caps_available.update(cap.split("=")[0] for cap in params[-1].split())
+            wanted = (CAPABILITIES & self.caps_available) - self.caps
+            if wanted:
+                self.sendLine("CAP REQ :%s" % " ".join(sorted(wanted)))
+        elif subcommand == "DEL":
+            for cap in params[-1].split():
+                self.caps_available.discard(cap)
+                self.caps.discard(cap)
+
+    def push_presence(self):
+        """ Whether the server tells us about away and login changes, so they don't have to be polled """
+        return PRESENCE_CAPABILITIES <= self.caps
+
     def signedOn(self):
         """Called when bot has succesfully signed on to server."""
         self.mode(chan=self.nickname, set=True, modes="B")
@@ -710,6 +1440,12 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         self.daily_loop = task.LoopingCall(self.daily_tasks)
         self.daily_loop.start(86400.0)
 
+        # Stores which can save cheaply are saved more often than every minute
+        self.commit_loop = None
+        if self.store.commit_interval:
+            self.commit_loop = task.LoopingCall(self.save)
+            self.commit_loop.start(self.store.commit_interval, now=False)
+
         if not self.channelsdefined:
             self.channellist = self.get_settings().channels
         for channel in self.channellist:
@@ -724,6 +1460,8 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         self.purgeOldNicks()
         self.purgeOldLogs()
         self.purgeOldMessages()
+        # Look at everything once a day, in case a change wasn't marked
+        self.changed()
 
     def joined(self, channel):
         """This will get called when the bot joins the channel."""
@@ -731,14 +1469,16 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         channel = self.get_channel(channel)
         # Also join triggersafe channels
         userchannel = False
-        try:
-            if str(channel).split("_")[1]:
-                userchannel = True
-                channelowner = self.get_channel_owner(str(channel).split("_")[1])
-                setattr(channel, "topicset", "%s's triggersafe channel. | %s[rules][mode]" % (channelowner, "[globalmotd]" if not self.check_for_master(self.get_user(channelowner)).motdread else ""))
-                self.update_rules(channel=channel)
-        except IndexError:
+        if channel.owner:
+            userchannel = True
+            channelowner = self.get_channel_owner(channel.owner)
+            setattr(channel, "topicset", "%s's triggersafe channel. | %s[rules][mode]" % (channelowner, "[globalmotd]" if not self.check_for_master(self.get_user(channelowner)).motdread else ""))
+            self.rules_dirty(channel)
+        elif channel.owner is None:
             setattr(channel, "topicset", "[globalmotd][rules]")
+        if self.push_presence():
+            # Only changes are pushed, so ask once who is away here
+            self.sendLine("WHO %s" % channel)
         if not userchannel:
             for user in self.users.itervalues():
                 if user.channel:
@@ -828,6 +1568,51 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
     def relay_safe(self, message, channel=None, action=False, user=None, relateduser=None, chat=True):
         if "silent" in channel.mode:
             return
+        basechannel = self.get_channel(channel.base)
+        tokens = self.tokenize(message)
+        # Lines folding to the same terms get the same verdict, as long as
+        # nothing it depends on changed. Patterns match the line as written.
+        # Verdicts naming bad words aren't cached, those quote the line.
+        patterns = self.family_patterns(basechannel).patterns
+        key = (tuple(term for word, term in tokens), message if patterns else None,
+               basechannel.name, channel.name, user.nick, self.verdict_version, basechannel.verdict_version)
+        cached = self.verdict_cache.lookup(key)
+        def filtered(matched):
+            if cached is not None:
+                verdict = cached
+            else:
+                if matched is None:
+                    # Not matched by a worker, do it here
+                    matched = self.matched_terms(message, basechannel, tokens)
+                verdict = self.family_verdict(matched, basechannel, channel, user)
+                if not verdict[2]:
+                    self.verdict_cache.store(key, verdict)
+            self.relay_verdict(verdict, message, basechannel, channel, action, user, relateduser, chat)
+        if self.filter_pool is None:
+            filtered(None)
+        elif cached is not None:
+            # Still relay in the order lines were said
+            self.filter_pool.ordered(channel.name, defer.succeed(None), filtered)
+        else:
+            # Match in a worker process, but relay in the order lines were said
+            self.filter_pool.ordered(channel.name,
+                self.filter_pool.matched_terms(message, self.get_settings().topicdetection), filtered)
+
+    def matched_terms(self, message, basechannel, tokens=None):
+        """ Tokenize and look up a message once, for all channels of a family """
+        if tokens is None:
+            tokens = self.tokenize(message)
+        matched = self.trigger_index.matched_terms(tokens)
+        matched.extend(self.family_patterns(basechannel).search(message))
+        matched.extend(self.detected_topics(tokens))
+        return matched
+
+    def family_verdict(self, matched, basechannel, channel, user):
+        """
+        Decide which channels of the family a line said in channel is hidden
+        from, given its matched terms.
+        Returns (hiddenchannels, badtopics, badwords, triggeredusers, collateralusers).
+        """
         badtopics = []
         badwords = []
         triggeredusers = []
@@ -835,17 +1620,13 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         collateralusers = []
         hiddenchannels = []
         hiddenusers = []
-        try:
-            basechannel = self.get_channel(str(channel).split("_")[0])
-        except IndexError:
-            basechannel = channel
-        for triggersafechannel in self.channels:
-            if str(triggersafechannel).startswith("%s_" % basechannel) and str(triggersafechannel) != str(channel):
-                channelowner = str(triggersafechannel).split("_")[1]
+        # Only intersect the matched terms with every channel's forbidden terms
+        terms = {term for word, term in matched}
+        for currentchannel in self.triggersafe_channels(basechannel.name):
+            if currentchannel is not channel:
                 # Check if this channel has a normal user
                 # If not, ignore it
                 bots = [self.nickname, "ChanServ", "NickServ"]
-                currentchannel = self.get_channel(triggersafechannel)
                 channelusers = currentchannel.users
                 for bot in bots:
                     if bot in channelusers:
@@ -853,6 +1634,8 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                 if not channelusers:
                     hiddenchannels.append(currentchannel)
                     continue
+                triggered = {member for term in terms.intersection(currentchannel.forbidden)
+                             for member in currentchannel.forbidden[term]}
                 # If we reached this point, someone is there. Keep it safe for them
                 for checkinguser in channelusers:
                     if currentchannel in hiddenchannels:
@@ -860,11 +1643,12 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                             collateralusers.append(checkinguser.nick)
                             continue
                     usertocheck = self.check_for_master(checkinguser)
-                    if "silent" in currentchannel.mode or ("rant" in channel.mode and (usertocheck.topics or usertocheck.trigger_words) and not "filterless" in currentchannel.mode) or user.nick in usertocheck.ignore:
+                    profile = self.trigger_index.profile(usertocheck)
+                    if "silent" in currentchannel.mode or ("rant" in channel.mode and profile and not "filterless" in currentchannel.mode) or user.nick in usertocheck.ignore:
                         ignoringusers.append(usertocheck.nick)
                         hiddenchannels.append(currentchannel)
-                    if not currentchannel in hiddenchannels and not "filterless" in currentchannel.mode:
-                        safe = self.is_safe(message=message, user=usertocheck)
+                    if not currentchannel in hiddenchannels and not "filterless" in currentchannel.mode and checkinguser in triggered:
+                        safe = self.verdict(profile.explain(matched))
                         if not safe[0]:
                             hiddenchannels.append(currentchannel)
                             if checkinguser.away and usertocheck.awaycheck:
@@ -889,6 +1673,11 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                 hiddenusers.append(entry.lower())
             if entry in collateralusers:
                 collateralusers.remove(entry)
+        return hiddenchannels, badtopics, badwords, triggeredusers, collateralusers
+
+    def relay_verdict(self, verdict, message, basechannel, channel, action, user, relateduser, chat):
+        """ The rest of relay_safe: tell users about hidden lines, and relay them """
+        hiddenchannels, badtopics, badwords, triggeredusers, collateralusers = verdict
         if collateralusers:
             collateraldamage = " Due to user location, it was also hidden from %s." % join_and(", ", " and ", collateralusers)
         else:
@@ -904,6 +1693,7 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                 (message, "subjects" if len(badtopics) > 1 else "subject", join_and(", ", " and ", badtopics), \
                 "words" if len(badwords) > 1 else "word", join_and(", ", " and ", badwords), \
                 join_and(", ", " and ", triggeredusers)))
+            self.changed(user)
             self.notifyAdmins(basechannel, "%s was prevented from triggering %s in %s. Type '!channel %s warnings list %s verbose 1' for more info." % (user, join_and(", ", " and ", triggeredusers), channel, basechannel, user))
         elif badtopics and not badwords:
             self.send_and_log(channel, user,
@@ -913,6 +1703,7 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             user.warnings[datetime.datetime.now()] = (basechannel, None, "Said %r, containing %s %s, being unsafe for %s." %
                 (message, "subjects" if len(badtopics) > 1 else "subject", join_and(", ", " and ", badtopics), \
                 join_and(", ", " and ", triggeredusers)))
+            self.changed(user)
             self.notifyAdmins(basechannel, "%s was prevented from triggering %s in %s. Type '!channel %s warnings list %s verbose 1' for more info." % (user, join_and(", ", " and ", triggeredusers), channel, basechannel, user))
         elif badwords and not badtopics:
             self.send_and_log(channel, user,
@@ -922,35 +1713,88 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             user.warnings[datetime.datetime.now()] = (basechannel, None, "Said %r, containing %s %s, being unsafe for %s." %
                 (message, "words" if len(badwords) > 1 else "word", join_and(", ", " and ", badwords), \
                 join_and(", ", " and ", triggeredusers)))
+            self.changed(user)
             self.notifyAdmins(basechannel, "%s was prevented from triggering %s in %s. Type '!channel %s warnings list %s verbose 1' for more info." % (user, join_and(", ", " and ", triggeredusers), channel, basechannel, user))
         self.relay(message=message, channel=channel, action=action, user=user, relateduser=relateduser, chat=chat, exclude=hiddenchannels)
     
-    def is_safe(self, message, user):
+    def tokenize(self, message):
+        """ Split a message into (word, stemmed word) tokens """
+        return triggerfilter.tokenize(message, self.fold, self.stem)
+
+    def stem_phrase(self, phrase):
+        """ Stem a trigger word or phrase the same way tokenize does """
+        return " ".join(self.stem(folded) for folded in (self.fold(word) for word in phrase.split()) if folded)
+
+    def fold_term(self, term):
+        """ Fold an already stemmed trigger term, "" for patterns no longer allowed """
+        if triggerfilter.is_pattern(term):
+            try:
+                triggerfilter.check_pattern(term)
+            except ValueError, e:
+                print "WARNING: Dropping stored trigger pattern %s: %s." % (term, e)
+                return ""
+            return term
+        return " ".join(folded for folded in (self.fold(word) for word in term.split()) if folded)
+
+    def trigger_term(self, entry):
+        """ Turn a trigger word, phrase or /pattern/ into the term to store """
+        if triggerfilter.is_pattern(entry):
+            try:
+                triggerfilter.check_pattern(entry)
+            except ValueError:
+                raise BadValue(entry)
+            return entry
+        return self.stem_phrase(entry)
+
+    def is_safe(self, message, user, tokens=None):
         """ Check if a topic is message is safe for an user """
-        badwords = []
-        badtopics = []
-        # First get a list of all words
-        wordlist = []
-        message = message.split(" ")
-        for word in message:
-            wordlist.append(word)
-        for word in wordlist:
-            stemmed = self.stem(word.lower())
-            # Then check this user's trigger words:
-            if stemmed in user.trigger_words:
-                if not word in badwords:
-                    badwords.append(word)
-            # Last but not least, check if the word is defined in a topic
-            for topic in user.topics:
-                level = user.topics[topic]
-                for x in range(1, level+1):
-                    try:
-                        if stemmed in topic.words[x]:
-                            if not topic.name in badtopics:
-                                badtopics.append(topic.name)
-                    except KeyError:
-                        # No triggerwords defined for this level
-                        continue
+        if tokens is None:
+            tokens = self.tokenize(message)
+        profile = self.trigger_index.profile(user)
+        matched = self.trigger_index.matched_terms(tokens)
+        if profile.patterns:
+            matched.extend(self.trigger_index.vocabulary.pattern_matcher(profile.patterns).search(message))
+        matched.extend(self.detected_topics(tokens))
+        return self.verdict(profile.explain(matched))
+
+    def log_path(self, name=""):
+        """
+        The path of the bot's log file, or of a rotated log next to it,
+        whose name starts with the log's. None if there is no such file.
+        """
+        current = getattr(self.logger.file, "name", None)
+        if not current or not os.path.isfile(current):
+            return None # Logging to the console
+        current = os.path.realpath(current)
+        path = os.path.realpath(os.path.join(os.path.dirname(current), name)) if name else current
+        if os.path.dirname(path) != os.path.dirname(current) \
+                or not os.path.basename(path).startswith(os.path.basename(current)):
+            return None
+        return path
+
+    def audit(self, messages, users):
+        """
+        Check many messages for many users at once, with the same verdicts
+        as is_safe. The users don't have to be known to the bot, so trigger
+        topics and words can be tried out before anyone has them.
+        Returns, for every message, a list of (user, verdict) for the users
+        the message is not safe for.
+        """
+        profiles = [(user, self.trigger_index.compile(user).reasons) for user in users]
+        vocabulary = self.trigger_index.vocabulary
+        missing = set(term for user, reasons in profiles for term in reasons) - vocabulary.terms
+        if missing:
+            vocabulary = vocabulary.extended(missing)
+        detect = self.get_settings().topicdetection
+        batch = [triggerfilter.match_all(vocabulary, self.topic_detector, self.tokenize(message), message, detect)
+                 for message in messages]
+        bulk = triggerfilter.BulkFilter(profiles)
+        return [[(user, self.verdict(bulk.explain(user, matched))) for user in unsafe]
+                for matched, unsafe in zip(batch, bulk.unsafe(batch))]
+
+    def verdict(self, explanation):
+        """ Turn a trigger index explanation into an is_safe style result """
+        badtopics, badwords = explanation
         if badtopics or badwords:
             return [False, badtopics, badwords]
         else:
@@ -978,31 +1822,35 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         else:
             assert False
    
+    def relay_info(self, message, channel=None, relateduser=None, notifyfriends=False):
+        """
+        Relay a join, part, quit or nick change after the lines still being
+        filtered for the channels it goes to (all of them when channel is None).
+        """
+        def send():
+            self.relay(message, channel, relateduser=relateduser, chat=False, notifyfriends=notifyfriends)
+        if self.filter_pool is None:
+            send()
+        elif channel is None:
+            self.filter_pool.ordered_all(list(self.filter_pool.queues), send)
+        else:
+            self.filter_pool.ordered_all([relaychannel.name for relaychannel in self.channel_family(channel.base)], send)
+
     def relay(self, message, channel=None, action=False, user=None, relateduser=None, chat=True, exclude=[], globalrelay=False, notifyfriends=False):
         """This will relay something to all related channels."""
         if channel == None:
-            for channel in self.channels.itervalues():
-                try:
-                    if str(channel).split("_")[1]:
-                        pass
-                except IndexError:
-                    self.relay(message=message, channel=channel, action=action, user=user, relateduser=relateduser, chat=chat, exclude=exclude, globalrelay=True, notifyfriends=notifyfriends)
+            for channel in self.base_channels():
+                self.relay(message=message, channel=channel, action=action, user=user, relateduser=relateduser, chat=chat, exclude=exclude, globalrelay=True, notifyfriends=notifyfriends)
         else:
-            excluded = []
-            for excluding in exclude:
-                excluded.append(excluding)
+            excluded = set(exclude)
             if user != None:
-                for checkignore in self.check_for_master(user).ignoredby:
-                    if not checkignore in excluded:
-                        excluded.append(checkignore)
+                excluded.update(self.check_for_master(user).ignoredby)
             if relateduser != None:
-                for checkignore in self.check_for_master(relateduser).ignoredby:
-                    if not checkignore in excluded:
-                        excluded.append(checkignore)
-            if str(channel).split("_")[0]:
-                basechannel = Channel(str(channel).split("_")[0])
-            for relaychannel in self.channels.itervalues():
-                if str(relaychannel).startswith("%s_" % basechannel) and str(relaychannel) != str(channel) and not relaychannel in excluded:
+                excluded.update(self.check_for_master(relateduser).ignoredby)
+            basechannel = self.channels.get(channel.base) or Channel(channel.base)
+            for relaychannel in self.triggersafe_channels(channel.base):
+                # Silent channels neither send nor receive anything
+                if relaychannel is not channel and not relaychannel in excluded and not "silent" in relaychannel.mode:
                     messagetosend = message
                     if notifyfriends:
                         friends = []
@@ -1081,12 +1929,63 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
 
     def checkAway(self, user=None):
         """This checks if someone is away by calling WHO."""
+        if self.push_presence():
+            return # The server tells us
         if user is None:
-            # Check all users!
-            self.sendLine("WHO 0")
+            # Check all users, spreading a WHO per channel over the interval
+            for call in self.who_calls:
+                if call.active():
+                    call.cancel()
+            targets = self.who_targets()
+            self.who_calls = [reactor.callLater(WHO_INTERVAL * number / len(targets), self.who, target)
+                              for number, target in enumerate(targets)]
         else:
             # Check a single user.
-            self.sendLine("WHO %s" % user)
+            self.who(user)
+
+    def who_targets(self):
+        """ Channels to ask WHO for, so that everyone in them is covered once """
+        covered = set()
+        targets = []
+        for channel in sorted(self.channels.itervalues(), key=lambda channel: -len(channel.users)):
+            if not channel.users <= covered:
+                targets.append(channel.name)
+                covered |= channel.users
+        return targets
+
+    def who(self, target):
+        if self.supported.hasFeature("WHOX"):
+            # Only ask for the token, channel, nick, flags and account
+            self.sendLine("WHO %s %%tcnfa,%s" % (target, WHOX_TOKEN))
+        else:
+            self.sendLine("WHO %s" % target)
+
+    def stats(self):
+        """ Returns a list of lines describing internal performance counters """
+        lines = []
+        if isinstance(self.fold, triggerfilter.LRUCache):
+            lines.append("Fold cache: %s." % self.fold.stats())
+        if isinstance(self.stem, triggerfilter.LRUCache):
+            lines.append("Stem cache: %s." % self.stem.stats())
+        lines.append("Pattern matcher cache: %s." % self.trigger_index.vocabulary.pattern_matchers.stats())
+        if self.get_settings().topicdetection:
+            lines.append("Topic detection: %s." % self.topic_detector.stats())
+        lines.append("Verdict cache: %s." % self.verdict_cache.stats())
+        lines.append("Rules updates: %s." % self.rules_scheduler.stats())
+        if self.last_save is not None:
+            lines.append("Saves: %d done, the last one wrote %d object(s) in %.2f ms." %
+                         (self.saves, self.last_save[0], self.last_save[1] * 1000))
+        if self.trigger_index.vocabulary.fuzzy_index is not None:
+            lines.append("Fuzzy lookup cache: %s." % self.trigger_index.vocabulary.fuzzy_index.cache.stats())
+        if self.filter_pool is not None:
+            lines.append("Filter workers: %s." % self.filter_pool.stats())
+        if self.push_presence():
+            presence = "away and login changes are pushed"
+        else:
+            presence = "polling WHO%s for %d channel(s) every minute" % (
+                "X" if self.supported.hasFeature("WHOX") else "", len(self.who_calls))
+        lines.append("Capabilities: %s (%s)." % (", ".join(sorted(self.caps)) or "none", presence))
+        return lines
 
     def purgeOldNicks(self):
         """ This gets rid of user entries in the database for nicknames 
@@ -1094,14 +1993,12 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         for user in self.users.values()[:]:
             # Don't purge admins or accounts explicitly marked as do-not-purge
             if not user.admin and user.autopurge and (datetime.datetime.now() - user.lastlogout).days > 30:
-                useronline = False
-                for channel in self.channels:
-                    if user in self.get_channel(channel).users:
-                        useronline = True
-                if not useronline:
+                if not self.memberships.channels_of(user):
                     if user.channel:
                         self.dispatch(command='unset channel', user=user, reply_to=user, bypass=True)
                     del self.users[user.nick]
+                    self.trigger_index.remove_user(user)
+                    self.changed(user)
     
     def purgeOldLogs(self):
         """ This gets rid of admin logs older than 30 days """
@@ -1110,7 +2007,7 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             for logdate in user.logs.keys():
                 if (datetime.datetime.now() - logdate).days > 30:
                     del user.logs[logdate]
-                    self.__dirty = True
+                    self.changed(user)
 
     def purgeOldMessages(self):
         """ This gets rid of user messages older than the defined limit """
@@ -1121,54 +2018,162 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
                     del user.messages[messagedate]
                     if messagedate in user.readmessages:
                         user.readmessages.remove(messagedate)
-                    self.__dirty = True
+                    self.changed(user)
 
     def irc_RPL_WHOREPLY(self, prefix, params):
         (my_nick, channel, username, hostmask, server,
             nickname, flags, hops_and_realname) = params
         hops, realname = hops_and_realname.split(" ", 1)
         user = self.get_user(nickname)
-        master = self.check_for_master(user)
         user.host = hostmask
-        # Check identified status
-        if "r" in flags and master.nickservlogin:
+        self.who_batch[user] = (flags, None)
+
+    def irc_RPL_WHOSPCRPL(self, prefix, params):
+        """ WHOX reply, with the fields asked for by who() """
+        if len(params) < 6 or params[1] != WHOX_TOKEN:
+            return
+        my_nick, token, channel, nickname, flags, account = params[:6]
+        self.who_batch[self.get_user(nickname)] = (flags, account)
+    irc_354 = irc_RPL_WHOSPCRPL
+
+    def apply_who_batch(self):
+        """ Apply the away and login states gathered from a chunk of WHO replies """
+        batch, self.who_batch = self.who_batch, {}
+        presence = {}
+        for user, (flags, account) in batch.iteritems():
+            master = self.check_for_master(user)
+            # Check identified status
+            if "r" in flags and master.nickservlogin:
+                user.logged_in = True
+            if account is not None:
+                self.set_account(user, account)
+            # Check away status
+            if "H" in flags:
+                presence[user] = False
+            elif "G" in flags:
+                presence[user] = True
+        self.apply_presence(presence)
+
+    def irc_AWAY(self, prefix, params):
+        """ away-notify: someone went away, or came back if there's no message """
+        self.apply_presence({self.get_user(prefix.split("!")[0]): bool(params and params[-1])})
+
+    def irc_ACCOUNT(self, prefix, params):
+        """ account-notify: someone logged in to or out of (*) their services account """
+        self.set_account(self.get_user(prefix.split("!")[0]), params[0])
+
+    def irc_JOIN(self, prefix, params):
+        if "extended-join" in self.caps:
+            # Channel, account and real name
+            irc.IRCClient.irc_JOIN(self, prefix, params[:1])
+        else:
+            irc.IRCClient.irc_JOIN(self, prefix, params)
+        nick = prefix.split("!")[0]
+        if nick != self.nickname and "@" in prefix:
+            user = self.get_user(nick)
+            user.host = prefix.split("@")[1]
+            if "extended-join" in self.caps:
+                self.set_account(user, params[1])
+
+    def set_account(self, user, account):
+        """ Log a user in if the services account they use matches their nick or that of their master """
+        master = self.check_for_master(user)
+        if account not in ("*", "0") and account.lower() in (user.nick.lower(), master.nick.lower()) and master.nickservlogin:
             user.logged_in = True
-        # Check away status
-        if "H" in flags:
-            user.away = False
+
+    def apply_presence(self, presence):
+        """ Apply {user: away} as seen by a batch of WHO replies or by away-notify, all at once """
+        changed = []
+        back = {} # Masters whose channels should relay again -> who came back
+        gone = {} # Masters whose channels should be silenced if everyone there is away -> who left
+        for user, away in presence.iteritems():
+            master = self.check_for_master(user)
+            if away and not master.awaycheck:
+                continue
+            if self.mark_away(user, away):
+                changed.append(user)
             if master.channel and master.autosilence:
-                for channel in self.channels:
-                    if not channel.endswith("_%s" % str(master).lower()):
-                        continue
-                    channel = self.get_channel(channel)
-                    if "silent" in channel.mode:
-                        self.dispatch(command="mode remove silent auto", user=user, reply_to=channel, bypass=True)
-        elif "G" in flags:
-            if not master.awaycheck:
-                return
-            user.away = True
-            if master.channel and master.topics and master.autosilence:
-                for channel in self.channels:
-                    if not channel.endswith("_%s" % str(master).lower()):
-                        continue
-                    channel = self.get_channel(channel)
+                if not away:
+                    back[master] = user
+                elif master.topics:
+                    gone[master] = user
+        if changed:
+            self.verdicts_changed()
+            self.refresh_rules(changed)
+        if back and not self.command_disabled("mode_remove_silent"):
+            for master, user in back.iteritems():
+                for channel in self.personal_channels(master):
+                    self.set_silent(channel, user, False)
+        if gone and not self.command_disabled("mode_add_silent"):
+            for master, user in gone.iteritems():
+                if master in back:
+                    continue
+                for channel in self.personal_channels(master):
                     # Only silence a channel if all its users are away.
-                    allaway = True
-                    for usercheck in channel.users:
-                        if usercheck.nick in ["ChanServ", "NickServ", self.nickname]:
-                            continue
-                        if not usercheck.away:
-                            allaway = False
-                            break
-                    if allaway and not "silent" in channel.mode:
-                        self.dispatch(command="mode add silent auto", user=user, reply_to=channel, bypass=True)
+                    if not channel.awake_members:
+                        self.set_silent(channel, user, True)
+
+    def command_disabled(self, name):
+        """ Whether an administrator disabled a command (as in mode_add_silent), or a command it's part of """
+        parts = name.split("_")
+        return any("_".join(parts[:x]) in self.get_settings().disabledcommands for x in range(1, len(parts)+1))
+
+    def personal_channels(self, master):
+        """ The #channel_nickname channels of a user """
+        channels = []
+        for basename in self.triggersafe:
+            channel = self.channels.get("%s_%s" % (basename, str(master).lower()))
+            if channel is not None:
+                channels.append(channel)
+        return channels
+
+    def set_silent(self, channel, user, silent):
+        """ Turn silent mode of a channel on or off and update its rules soon, returns whether it changed """
+        if silent:
+            for incompatible in ["filterless", "rant"]:
+                if incompatible in channel.mode:
+                    channel.mode.remove(incompatible)
+                    self.changed(channel)
+                    self.verdicts_changed(channel)
+        if silent == ("silent" in channel.mode):
+            return False
+        self.changed(channel)
+        self.rules_dirty(channel)
+        if silent:
+            channel.mode.append("silent")
+            self.verdicts_changed(channel)
+            self.send_and_log(channel, user,
+                "Relaying disabled.")
+            self.relay_info("%s has left (Relaying disabled)." % user, channel, relateduser=user)
+        else:
+            channel.mode.remove("silent")
+            self.verdicts_changed(channel)
+            self.send_and_log(channel, user,
+                "Relaying enabled.")
+            self.relay_info("%s has joined (Relaying enabled)." % user, channel, relateduser=user, notifyfriends=True)
+        return True
 
     def irc_RPL_ENDOFWHO(self, prefix, params):
-        self.update_rules()
+        self.apply_who_batch()
 
     def irc_RPL_TOPIC(self, prefix, params):
         self.irc_TOPIC(prefix, params)
 
+    def irc_ERR_CHANOPRIVSNEEDED(self, prefix, params):
+        """ We aren't a channel operator, so a topic we sent may not have been set """
+        channel = self.channels.get(params[1].lower()) if len(params) > 1 else None
+        if channel is not None:
+            # Send it again on the next update, instead of taking it as set
+            channel.topic_sent = None
+            channel.rules_key = None
+
+    def modeChanged(self, user, channel, set, modes, args):
+        """ Once we are made a channel operator, send a topic the server refused again """
+        if set and "o" in modes and self.nickname in args:
+            channel = self.channels.get(channel.lower())
+            if channel is not None and channel.topic_sent is None:
+                self.rules_dirty(channel)
+
     def irc_TOPIC(self, prefix, params):
         if len(params) > 2: # Yay, dealing with irc_TOPIC and irc_RPL_TOPIC inconsistencies
             channel = self.get_channel(params[1])
@@ -1182,6 +2187,7 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             setattr(channel, "topic", topic)
         else:
             setattr(channel, "topicset", topic)
+            self.rules_dirty(channel)
 
     def userRenamed(self, oldnick, newnick):
         self.logger.log("%s is now known as %s." % (oldnick, newnick))
@@ -1190,14 +2196,13 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         self.check_for_master(olduser).seen = datetime.datetime.now()
         self.check_for_master(newuser).seen = datetime.datetime.now()
         relayedchannels = []
-        for channel in self.channels.itervalues():
-            if olduser in channel.users:
-                channel.users.remove(olduser)
-                channel.users.add(newuser)
-                if not str(channel).split("_")[0] in relayedchannels:
-                    self.relay("%s is now known as %s." % # TODO: Fake join/quit when old/new nick is on ignore list
-                        (oldnick, newnick), channel, chat=False)
-                    relayedchannels.append(str(channel).split("_")[0])
+        for channel in list(self.memberships.channels_of(olduser)):
+            self.remove_member(channel, olduser)
+            self.add_member(channel, newuser)
+            if not channel.base in relayedchannels:
+                self.relay_info("%s is now known as %s." % # TODO: Fake join/quit when old/new nick is on ignore list
+                    (oldnick, newnick), channel)
+                relayedchannels.append(channel.base)
 
     # This code is used to get a list of people there.
     def irc_RPL_NAMREPLY(self, prefix, params):
@@ -1205,10 +2210,18 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         my_user, _, channel, nicks = params
         channel = self.get_channel(channel)
         for nick in nicks.split():
-            nick = re.sub(r'^[~&@%+]', "", nick)
+            # With multi-prefix, there may be several status prefixes
+            nick = re.sub(r'^[~&@%+]+', "", nick)
+            host = None
+            if "!" in nick:
+                # userhost-in-names gives nick!user@host
+                nick, host = nick.split("!", 1)
+                host = host.split("@")[-1]
             if nick != self.nickname:
                 user = self.get_user(nick)
-                channel.users.add(user)
+                if host:
+                    user.host = host
+                self.add_member(channel, user)
 
     def irc_RPL_ENDOFNAMES(self, prefix, params):
         "We know everyone. List admins and rules"
@@ -1216,24 +2229,14 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         channel = self.get_channel(channel)
         self.logger.log("[%s] NAMES: %s" % (channel.name,
             " ".join(user.nick for user in channel.users)))
-        reactor.callLater(10, self.update_rules, channel=channel)
+        self.rules_dirty(channel)
 
     def userJoined(self, nick, channel):
         self.logger.log("[%s] %s has joined." % (channel, nick))
         user = self.get_user(nick, create_if_nonexistent=False)
         joinchannel = self.get_channel(channel)
-        users = []
-        for onlineuser in self.get_channel(str(channel).split("_")[0]).users:
-            users.append(onlineuser.nick)
-        for relaychannel in self.channels.itervalues():
-            try:
-                if str(relaychannel).split("_")[1]:
-                    if str(relaychannel).split("_")[0] == str(channel).split("_")[0]:
-                        for onlineuser in relaychannel.users:
-                            if not onlineuser.nick in users:
-                                users.append(onlineuser.nick)
-            except IndexError:
-                pass
+        # Whether they're already somewhere in this channel's family
+        present = user is not None and joinchannel.base in self.memberships.families_of(user)
         if user == None:
             user = self.get_user(nick)
             self.send_and_log(joinchannel, user,
@@ -1248,9 +2251,9 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             self.send_and_log(joinchannel, user,
                 "You have unread messages. Please check them using '!mail inbox unread'.")
         if (not "_" in channel and not self.get_settings().maindisabled) or ("_" in channel and not "silent" in joinchannel.mode):
-            if not nick in users:
-                self.relay("%s has joined." % nick, joinchannel, relateduser=self.find_user(nick), chat=False, notifyfriends=True)
-            joinchannel.users.add(user)
+            if not present:
+                self.relay_info("%s has joined." % nick, joinchannel, relateduser=self.find_user(nick), notifyfriends=True)
+            self.add_member(joinchannel, user)
         elif self.get_settings().maindisabled:
             if not user.channel:
                 self.dispatch(command="set channel", user=user, reply_to=joinchannel, bypass=True)
@@ -1266,38 +2269,34 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
         master = self.check_for_master(user)
         leavechannel = self.get_channel(channel)
         try:
-            leavechannel.users.remove(user)
+            self.remove_member(leavechannel, user)
         except KeyError:
             return
         stillonline = False
         hideleave = False
-        for channel in self.channels.itervalues():
-            if user in channel.users:
-                if not "silent" in channel.mode:
-                    stillonline = True
-                else:
-                    hideleave = True
+        for channel in self.memberships.channels_of(user):
+            if not "silent" in channel.mode:
+                stillonline = True
+            else:
+                hideleave = True
         if not stillonline:
             if not hideleave:
-                self.relay("%s has left." % nick, leavechannel, relateduser=user, chat=False)
+                self.relay_info("%s has left." % nick, leavechannel, relateduser=user)
             if master.autologout:
                 user.logged_in = False
-        self.update_rules(channel=channel)
+        self.rules_dirty(leavechannel)
         master.seen = datetime.datetime.now()
         user.lastlogout = datetime.datetime.now()
 
     def userQuit(self, nick, message):
         self.logger.log("%s has quit (%s)." % (nick, message))
         user = self.get_user(nick)
-        exclude = []
-        for channel in self.channels.itervalues():
-            channel.users.discard(user)
-            if user in channel.users or ("_" in channel and "silent" in channel.mode):
-                exclude.append(channel)
+        for channel in list(self.memberships.channels_of(user)):
+            self.remove_member(channel, user)
         if not message.startswith("Quit: "):
-            self.relay("%s has quit (%s)." % (nick, message), relateduser=user, chat=False, exclude=exclude)
+            self.relay_info("%s has quit (%s)." % (nick, message), relateduser=user)
         else:
-            self.relay("%s has quit." % nick, relateduser=user, chat=False, exclude=exclude)
+            self.relay_info("%s has quit." % nick, relateduser=user)
         master = self.check_for_master(user)
         master.seen = datetime.datetime.now()
         user.lastlogout = datetime.datetime.now()
@@ -1315,36 +2314,22 @@ class TriggerBot(irc.IRCClient, reloading.Reloadable):
             (channel, kicked, kicker, message))
         channel = self.get_channel(channel)
         try:
-            channel.users.remove(self.get_user(kicked))
+            self.remove_member(channel, self.get_user(kicked))
         except KeyError:
             return
-        users = []
-        for onlineuser in self.get_channel(str(channel).split("_")[0]).users:
-            users.append(onlineuser.nick)
-        for relaychannel in self.channels.itervalues():
-            try:
-                if str(relaychannel).split("_")[1]:
-                    if str(relaychannel).split("_")[0] == str(channel).split("_")[0] and relaychannel != channel:
-                        for onlineuser in relaychannel.users:
-                            if not onlineuser.nick in users:
-                                users.append(onlineuser.nick)
-            except IndexError:
-                pass
-        if not kicked in users:
-            self.relay("%s has left (kicked by %s)." %
-                (kicked, kicker), channel, relateduser=self.find_user(kicked), chat=False)
+        if not channel.base in self.memberships.families_of(self.get_user(kicked)):
+            self.relay_info("%s has left (kicked by %s)." %
+                (kicked, kicker), channel, relateduser=self.find_user(kicked))
         else:
-            self.relay("%s was kicked by %s." %
-                (kicked, kicker), channel, relateduser=self.find_user(kicked), chat=False)
-        self.update_rules(channel=channel)
+            self.relay_info("%s was kicked by %s." %
+                (kicked, kicker), channel, relateduser=self.find_user(kicked))
+        self.rules_dirty(channel)
         user = self.get_user(kicked)
         self.check_for_master(user).seen = datetime.datetime.now()
         user.lastlogout = datetime.datetime.now()
 
     def irc_RPL_AWAY(self, prefix, params):
-        nick = params[1]
-        self.get_user(nick).away = True
-        self.update_rules()
+        self.apply_presence({self.get_user(params[1]): True})
 
 def admin_command(f):
     def wrapper(bot, params, user, recipient, mainchannel, bypass=False):
@@ -1377,10 +2362,7 @@ def channelmod_command(f):
 
 def toggleable_command(f):
     def wrapper(bot, params, user, recipient, mainchannel, bypass=False):
-        commandcores = []
-        for x in range(1, len(wrapper.__name__.split("_"))+1):
-            commandcores.append("_".join(wrapper.__name__.split("_")[:x]))
-        if any(commandcore in bot.get_settings().disabledcommands for commandcore in commandcores):
+        if bot.command_disabled(wrapper.__name__):
             bot.send_and_log(recipient, user,
                 "This command has been disabled by an administrator.")
         else:
@@ -1402,6 +2384,7 @@ def logged_command(f):
     def wrapper(bot, params, user_executed, recipient, mainchannel, bypass=False):
         user = bot.check_for_master(user_executed)
         user.logs[datetime.datetime.now()] = [mainchannel, "%s %s" % (" ".join(wrapper.__name__.split("_")), " ".join(params))]
+        bot.changed(user)
         return f(bot, params, user_executed, recipient, mainchannel, bypass)
     wrapper.__name__ = f.__name__
     return wrapper
@@ -1414,9 +2397,8 @@ def register_commands():
              "admins")
     @toggleable_command
     def admins(bot, params, user_executed, recipient, mainchannel, bypass=False):
-        avail_admins = [user.nick for channel in bot.channels.itervalues()
-                        for user in channel.users
-                        if not user.away and (user.admin or (user.nick in mainchannel.admins and str(mainchannel) == str(channel).split("_")[0]))]
+        avail_admins = [user.nick for user in bot.memberships.channels
+                        if not user.away and (user.admin or (user.nick in mainchannel.admins and str(mainchannel) in bot.memberships.families_of(user)))]
         unavail_admins = [user.nick for user in bot.users.itervalues()
                           if (user.admin or user.nick in mainchannel.admins) and user.nick not in avail_admins]
         if avail_admins:
@@ -1436,9 +2418,7 @@ def register_commands():
     @toggleable_command
     def change(bot, params, user, recipient, mainchannel, bypass=False):
         if len(params) > 0:
-            channel = bot.get_channel(params[0])
-            if not is_channel_name(channel.name):
-                channel.name = "#%s" % channel.name
+            channel = bot.get_channel(params[0] if is_channel_name(params[0]) else "#%s" % params[0])
         else:
             channel = recipient
             if not getattr(channel, "is_channel", False):
@@ -1469,7 +2449,7 @@ def register_commands():
                     mainchannel.admins.append(master.nick)
             bot.send_and_log(recipient, user_executed,
                 "Requested user(s) now have channel administrator status.")
-            bot.changed()
+            bot.changed(mainchannel)
         else:
             raise MissingParams
 
@@ -1485,7 +2465,7 @@ def register_commands():
                     mainchannel.admins.remove(nick)
             bot.send_and_log(recipient, user_executed,
                 "Requested user(s) no longer have channel administrator status.")
-            bot.changed()
+            bot.changed(mainchannel)
         else:
             raise MissingParams
 
@@ -1496,11 +2476,10 @@ def register_commands():
     @logged_command
     def channel_announce(bot, params, user, recipient, mainchannel, bypass=False):
         if params:
-            for channel in bot.channels.itervalues():
-                if str(channel) == str(mainchannel) or str(channel).startswith("%s_" % mainchannel):
-                    bot.notice(channel,
-                        "Announcement from %s: %s" %
-                            (user.nick, " ".join(params)))
+            for channel in bot.channel_family(mainchannel.name):
+                bot.notice(channel,
+                    "Announcement from %s: %s" %
+                        (user.nick, " ".join(params)))
         else:
             raise MissingParams
 
@@ -1512,9 +2491,8 @@ def register_commands():
     def channel_kick(bot, params, user, recipient, mainchannel, bypass=False):
         if not params:
             raise MissingParams
-        for channel in bot.channels.itervalues():
-            if str(channel) == str(mainchannel) or str(channel).startswith("%s_" % mainchannel):
-                bot.kick(str(channel), params[0], "%s: %s" % (user, params[1:] if len(params) >= 2 else "no reason specified."))
+        for channel in bot.channel_family(mainchannel.name):
+            bot.kick(str(channel), params[0], "%s: %s" % (user, params[1:] if len(params) >= 2 else "no reason specified."))
 
     @command("Order the bot to ban an user.\n"
              "channel ban <user>")
@@ -1525,9 +2503,8 @@ def register_commands():
         if not params:
             raise MissingParams
         toban = bot.get_user(params[0])
-        for channel in bot.channels.itervalues():
-            if str(channel) == str(mainchannel) or str(channel).startswith("%s_" % mainchannel):
-                bot.mode(chan=str(channel), set=True, modes="b", mask="*!*@%s" % toban.host)
+        for channel in bot.channel_family(mainchannel.name):
+            bot.mode(chan=str(channel), set=True, modes="b", mask="*!*@%s" % toban.host)
    
     @command("Remove the ban on an user.\n"
              "channel unban <user>")
@@ -1536,9 +2513,8 @@ def register_commands():
     @logged_command
     def channel_unban(bot, params, user, recipient, mainchannel, bypass=False):
         tounban = bot.get_user(params[0])
-        for channel in bot.channels.itervalues():
-            if str(channel) == str(mainchannel) or str(channel).startswith("%s_" % mainchannel):
-                bot.mode(chan=str(channel), set=False, modes="b", mask="*!*@%s" % tounban.host)
+        for channel in bot.channel_family(mainchannel.name):
+            bot.mode(chan=str(channel), set=False, modes="b", mask="*!*@%s" % tounban.host)
 
     @command("Order the bot to kickban an user.\n"
              "channel kickban <user>")
@@ -1634,7 +2610,11 @@ def register_commands():
             number += 2
         bot.send_and_log(recipient, user,
             "The requested topics are now blocked")
-        bot.changed()
+        bot.changed(mainchannel)
+        # Check everyone already there against the new blocks
+        family = bot.get_channel(mainchannel.base).family_rules
+        family.unchecked.update(family.contributions)
+        bot.update_rules(mainchannel)
 
     @command("Unblock one or more trigger topics.\n"
              "channel topicblock remove <topic>")
@@ -1646,7 +2626,7 @@ def register_commands():
             del mainchannel.blockedtopics[param]
         bot.send_and_log(recipient, user,
             "The requested topics are no longer blocked")
-        bot.changed()
+        bot.changed(mainchannel)
 
     @command("List blocked trigger topics.\n"
              "channel topicblock list")
@@ -1666,6 +2646,7 @@ def register_commands():
         if len(params) > 0:
             user = bot.find_user(params[0])
             user.warnings[datetime.datetime.now()] = mainchannel, user_executed.nick, str(" ".join(params[1:])) if len(params) > 1 else None
+            bot.changed(user)
             warningsbytriggerbot = 0
             for entry in user.warnings.keys():
                 if user.warnings[entry][1] == None:
@@ -1789,7 +2770,7 @@ def register_commands():
                             self.mode(channel, True, "I %s!*@*" % allowed) # Add an invite-only exception
             bot.send_and_log(recipient, user_executed,
                 "The requested users were added to your channelallow list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -1808,7 +2789,7 @@ def register_commands():
                             self.mode(channel, False, "I %s!*@*" % allowed) # Remove the invite-only exception
             bot.send_and_log(recipient, user_executed,
                 "The requested users are no longer on your channelallow list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -1835,7 +2816,8 @@ def register_commands():
         user.trigger_words.update(source_user.trigger_words)
         for topic, level in source_user.topics.iteritems():
             user.topics[topic] = max(user.topics.get(topic, 0), level)
-        bot.changed()
+        bot.triggers_changed(user)
+        bot.changed(user)
         bot.send_and_log(recipient, user_executed, "It is done.")
         bot.update_rules()
 
@@ -1857,7 +2839,7 @@ def register_commands():
                     user.friends.append(entry)
             bot.send_and_log(recipient, user_executed,
                 "The requested users were added to your friend list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -1873,7 +2855,7 @@ def register_commands():
                     user.friends.remove(entry)
             bot.send_and_log(recipient, user_executed,
                 "The requested users are no longer on your friend list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -1926,13 +2908,16 @@ def register_commands():
                             master = bot.find_user(user_executed.master)
                             if user_executed.nick in master.alts:
                                 master.alts.remove(user_executed.nick)
+                                bot.changed(master)
                         user_executed.master = params[0]
                     else:
                         bot.send_and_log(recipient, user_executed,
                             "%s is already an alt. You can only link an alt to an account which is not an alt itself."
                                 % user.nick)
                         return
-                    bot.changed()
+                    bot.refresh_views([user_executed])
+                    bot.refresh_rules([user_executed])
+                    bot.changed(user, user_executed)
                     bot.send_and_log(recipient, user_executed,
                         "You are now registered as an alt of %s."
                             % params[0])
@@ -1951,6 +2936,7 @@ def register_commands():
     @protected_command
     @toggleable_command
     def group_remove(bot, params, user_executed, recipient, mainchannel, bypass=False):
+        ungrouped = [user_executed]
         if user_executed.master:
             user = bot.find_user(user_executed.master)
             altlist = user.alts
@@ -1963,8 +2949,11 @@ def register_commands():
             for user in altlist:
                 user = bot.find_user(user)
                 user.master = None
+                ungrouped.append(user)
             user_executed.alts = []
-        bot.changed()
+        bot.refresh_views(ungrouped)
+        bot.refresh_rules(ungrouped)
+        bot.changed(*ungrouped)
         bot.send_and_log(recipient, user_executed,
             "This account is no longer grouped.")
 
@@ -2110,10 +3099,12 @@ def register_commands():
                     user.ignore.append(ignored.nick)
                 if not user.nick in ignored.ignoredby:
                     ignored.ignoredby.append(user.nick)
+                bot.changed(ignored)
+            bot.verdicts_changed()
             bot.send_and_log(recipient, user_executed,
                 "The requested %s added to your ignore list" %
                     ("users were" if len(params) > 1 else "user was"))
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
         
@@ -2128,10 +3119,12 @@ def register_commands():
                     user.ignore.remove(ignored.nick)
                 if user.nick in ignored.ignoredby:
                     ignored.ignoredby.remove(user.nick)
+                bot.changed(ignored)
+            bot.verdicts_changed()
             bot.send_and_log(recipient, user_executed,
                 "The requested %s removed from your ignore list" %
                     ("users were" if len(params) > 1 else "user was"))
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
     
@@ -2239,6 +3232,7 @@ def register_commands():
                     return
                 if not messagelist[number] in user.readmessages:
                     user.readmessages.append(messagelist[number])
+        bot.changed(user)
         bot.send_and_log(recipient, user_executed,
             "Marked %s %s as read" % ("all" if not params else len(params), "message" if len(params) == 1 else "messages"))
 
@@ -2264,6 +3258,7 @@ def register_commands():
                     return
                 if messagelist[number] in user.readmessages:
                     user.readmessages.remove(messagelist[number])
+        bot.changed(user)
         bot.send_and_log(recipient, user_executed,
             "Marked %s %s as unread" % ("all" if not params else len(params), "message" if len(params) == 1 else "messages"))
 
@@ -2291,6 +3286,7 @@ def register_commands():
                     "[%s] %s: %s" % (number+1, user.messages[messageid][0], user.messages[messageid][1]))
                 if not messageid in user.readmessages:
                     user.readmessages.append(messageid)
+                    bot.changed(user)
             except IndexError:
                 raise MessageNotFound(number+1)
         elif user.messages:
@@ -2299,6 +3295,7 @@ def register_commands():
                 if message in user.readmessages:
                     continue
                 user.readmessages.append(message)
+                bot.changed(user)
                 messagesfound = True
                 bot.send_and_log(recipient, user_executed,
                     "[%s] %s: %s" % (number+1, user.messages[message][0], user.messages[message][1]))
@@ -2336,6 +3333,7 @@ def register_commands():
                 raise MessageNotFound(number+1)
             if messagelist[number] in user.readmessages:
                 user.readmessages.remove(messagelist[number])
+            bot.changed(user)
             bot.send_and_log(recipient, user_executed,
                 "Message removed.")
 
@@ -2353,6 +3351,7 @@ def register_commands():
                     "Sorry, but your message to %s was not sent due to it possibly being unsafe" % params[0])
                 return
             user.messages[datetime.datetime.now()] = user_executed, message
+            bot.changed(user)
             bot.send_and_log(recipient, user_executed,
                 "Your message to %s was sent succesfully." % params[0])
             # Message the user and their alts. Why let them wait until they log in if they're there?
@@ -2360,16 +3359,15 @@ def register_commands():
             receivers = [user]
             for alt in user.alts:
                 receivers.append(bot.find_user(alt))
-            for channel in bot.channels:
-                channeldata = bot.get_channel(channel)
-                for receiver in receivers[:]:
-                    if receiver in channeldata.users:
-                        if channeldata in receiverchannels:
-                            continue
-                        bot.send_and_log(channeldata, receiver,
-                            "You have received a new message. Please check your unread messages using '!mail inbox unread'.")
-                        receivers.remove(receiver)
-                        receiverchannels.append(channeldata)
+            for receiver in receivers[:]:
+                for channeldata in bot.memberships.channels_of(receiver):
+                    if channeldata in receiverchannels:
+                        continue
+                    bot.send_and_log(channeldata, receiver,
+                        "You have received a new message. Please check your unread messages using '!mail inbox unread'.")
+                    receivers.remove(receiver)
+                    receiverchannels.append(channeldata)
+                    break
             for receiver in receivers:
                 bot.send_and_log(receiver, receiver,
                     "You have received a new message. Please check your unread messages using '!mail inbox unread'.")
@@ -2416,8 +3414,12 @@ def register_commands():
         for incompatible in ["silent"]:
             if incompatible in recipient.mode:
                 recipient.mode.remove(incompatible)
+                bot.changed(recipient)
+                bot.verdicts_changed(recipient)
         if not "filterless" in recipient.mode:
             recipient.mode.append("filterless")
+            bot.changed(recipient)
+            bot.verdicts_changed(recipient)
             bot.send_and_log(recipient, user,
                 "Mode filterless added.")
             bot.update_rules(recipient)
@@ -2432,6 +3434,8 @@ def register_commands():
     def mode_remove_filterless(bot, params, user, recipient, mainchannel, bypass=False):
         if "filterless" in recipient.mode:
             recipient.mode.remove("filterless")
+            bot.changed(recipient)
+            bot.verdicts_changed(recipient)
             bot.send_and_log(recipient, user,
                 "Mode filterless removed.")
             bot.update_rules(recipient)
@@ -2448,8 +3452,12 @@ def register_commands():
         for incompatible in ["silent"]:
             if incompatible in recipient.mode:
                 recipient.mode.remove(incompatible)
+                bot.changed(recipient)
+                bot.verdicts_changed(recipient)
         if not "rant" in recipient.mode:
             recipient.mode.append("rant")
+            bot.changed(recipient)
+            bot.verdicts_changed(recipient)
             bot.send_and_log(recipient, user,
                 "Mode rant added.")
             bot.update_rules(recipient)
@@ -2464,6 +3472,8 @@ def register_commands():
     def mode_remove_rant(bot, params, user, recipient, mainchannel, bypass=False):
         if "rant" in recipient.mode:
             recipient.mode.remove("rant")
+            bot.changed(recipient)
+            bot.verdicts_changed(recipient)
             bot.send_and_log(recipient, user,
                 "Mode rant removed.")
             bot.update_rules(recipient)
@@ -2476,14 +3486,7 @@ def register_commands():
     @protected_command
     @toggleable_command
     def mode_add_silent(bot, params, user, recipient, mainchannel, bypass=False):
-        for incompatible in ["filterless", "rant"]:
-            if incompatible in recipient.mode:
-                recipient.mode.remove(incompatible)
-        if not "silent" in recipient.mode:
-            recipient.mode.append("silent")
-            bot.send_and_log(recipient, user,
-                "Relaying disabled.")
-            bot.relay("%s has left (Relaying disabled)." % user, recipient, relateduser=user, chat=False)
+        if bot.set_silent(recipient, user, True):
             if not params:
                 bot.update_rules(recipient)
         elif not params:
@@ -2495,11 +3498,7 @@ def register_commands():
     @protected_command
     @toggleable_command
     def mode_remove_silent(bot, params, user, recipient, mainchannel, bypass=False):
-        if "silent" in recipient.mode:
-            recipient.mode.remove("silent")
-            bot.send_and_log(recipient, user,
-                "Relaying enabled.")
-            bot.relay("%s has joined (Relaying enabled)." % user, recipient, relateduser=user, chat=False, notifyfriends=True)
+        if bot.set_silent(recipient, user, False):
             if not params:
                 bot.update_rules(recipient)
         elif not params:
@@ -2512,6 +3511,7 @@ def register_commands():
     @toggleable_command
     def mode_reset(bot, params, user, recipient, mainchannel, bypass=False):
         recipient.mode = []
+        bot.verdicts_changed(recipient)
         bot.send_and_log(recipient, user,
             "Channel mode reset.")
         bot.update_rules(recipient)
@@ -2521,9 +3521,7 @@ def register_commands():
     @toggleable_command
     def names(bot, params, user_executed, recipient, mainchannel, bypass=False):
         if len(params) > 0:
-            channel = bot.get_channel(params[0])
-            if not is_channel_name(channel.name):
-                channel.name = "#%s" % channel.name
+            channel = bot.get_channel(params[0] if is_channel_name(params[0]) else "#%s" % params[0])
         else:
             channel = recipient
             if not getattr(channel, "is_channel", False):
@@ -2532,16 +3530,14 @@ def register_commands():
                 return
         users = []
         # In case it's a triggersafe channel, get the base channel
-        basechannel = str(channel).split("_")[0]
-        for checkchannel in bot.channels.itervalues():
+        for checkchannel in bot.channel_family(channel.base):
             if "silent" in checkchannel.mode:
                 continue
-            if str(checkchannel) == basechannel or str(checkchannel).startswith("%s_" % basechannel):
-                for user in checkchannel.users:
-                    if user.nick in ["ChanServ", "NickServ"]:
-                        continue
-                    if not user.nick in users:
-                        users.append(user.nick)
+            for user in checkchannel.users:
+                if user.nick in ["ChanServ", "NickServ"]:
+                    continue
+                if not user.nick in users:
+                    users.append(user.nick)
         users.sort()
         bot.send_and_log(recipient, None,
             "Nicks %s: [%s]" % (recipient, " ".join(users)))
@@ -2552,12 +3548,9 @@ def register_commands():
         user = bot.check_for_master(user_executed)
         if user.friends and not alert_channel_if_not_helped:
             userfound = False
-            userlist = []
-            for channel in bot.channels.itervalues():
-                for person in channel.users:
-                    userlist.append(person)
-            for person.nick in user.friends:
-                if person in userlist:
+            for friend in user.friends:
+                person = bot.users.get(friend)
+                if person is not None and bot.memberships.channels_of(person):
                     bot.send_and_log(person, None, "%s isn't feeling so well and would like you to comfort them." % user_executed)
                     bot.send_and_log(person, None, "If you can hear them out, please type '/query %s' to start a private conversation with them." % user_executed)
                     userfound = True
@@ -2603,9 +3596,7 @@ def register_commands():
     @toggleable_command
     def rules(bot, params, user, recipient, mainchannel, bypass=False):
         if len(params) > 0:
-            channel = bot.get_channel(params[0])
-            if not is_channel_name(channel.name):
-                channel.name = "#%s" % channel.name
+            channel = bot.get_channel(params[0] if is_channel_name(params[0]) else "#%s" % params[0])
         else:
             channel = recipient
             if not getattr(channel, "is_channel", False):
@@ -2650,7 +3641,9 @@ def register_commands():
         user.awaycheck = True
         bot.send_and_log(recipient, user_executed,
             "Awaycheck set.")
-        bot.changed()
+        bot.changed(user)
+        bot.verdicts_changed()
+        bot.refresh_rules([user])
         bot.update_rules()
 
     @command("When unset, triggerbot applies your trigger topics and"
@@ -2663,7 +3656,9 @@ def register_commands():
         user.awaycheck = False
         bot.send_and_log(recipient, user_executed,
             "Awaycheck unset.")
-        bot.changed()
+        bot.changed(user)
+        bot.verdicts_changed()
+        bot.refresh_rules([user])
         bot.update_rules()
 
     @command("when set, triggerbot will silence your channel when you"
@@ -2676,7 +3671,7 @@ def register_commands():
         user.autosilence = True
         bot.send_and_log(recipient, user_executed,
             "autosilence set.")
-        bot.changed()
+        bot.changed(user)
 
     @command("when unset, triggerbot will not silence your channel when you"
              " go away (requires awaycheck to be set).\n"
@@ -2688,7 +3683,7 @@ def register_commands():
         user.autosilence = False
         bot.send_and_log(recipient, user_executed,
             "autosilence set.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When set, triggerbot will automatically log you out when you quit"
              " or leave all channels the bot is in.\n"
@@ -2700,7 +3695,7 @@ def register_commands():
         user.autologout = True
         bot.send_and_log(recipient, user_executed,
             "Autologout set.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When unset, triggerbot will keep you logged in, even if you"
              " quit or leave all channels the bot is in.\n"
@@ -2712,7 +3707,7 @@ def register_commands():
         user.autologout = False
         bot.send_and_log(recipient, user_executed,
             "Autologout unset.")
-        bot.changed()
+        bot.changed(user)
     
     @command("When set, triggerbot will not report your own triggers in"
              " your own triggersafe channels.\n"
@@ -2724,7 +3719,9 @@ def register_commands():
         user.hideown = True
         bot.send_and_log(recipient, user_executed,
             "Your triggers will no longer be displayed in your own channel(s).")
-        bot.changed()
+        for channel in bot.personal_channels(user):
+            bot.rules_dirty(channel)
+        bot.changed(user)
 
     @command("When unset, triggerbot will also report your own triggers in"
              " your triggersafe channels.\n"
@@ -2736,7 +3733,9 @@ def register_commands():
         user.hideown = False
         bot.send_and_log(recipient, user_executed,
             "Your triggers will be displayed in your own channel(s).")
-        bot.changed()
+        for channel in bot.personal_channels(user):
+            bot.rules_dirty(channel)
+        bot.changed(user)
 
     @command("When set, triggerbot will not see any of your sentences in a"
              " private chat as commands and will listen to you like"
@@ -2749,7 +3748,7 @@ def register_commands():
         user.listenmode = True
         bot.send_and_log(recipient, user_executed,
             "Listenmode set.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When unset, triggerbot will see your messages in a"
              " private channel as commands.\n"
@@ -2761,7 +3760,7 @@ def register_commands():
         user.listenmode = False
         bot.send_and_log(recipient, user_executed,
             "Listenmode unset.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When set, the MOTD will not be displayed in your channel.\n"
              "set motdread")
@@ -2772,10 +3771,10 @@ def register_commands():
         user.motdread = True
         bot.send_and_log(recipient, user_executed,
             "MOTD marked as read. The channel topic for your triggersafe channel(s) will be updated soon.")
-        for channel in bot.channels:
-            if channel.endswith("_%s" % user.nick.lower()):
-                setattr(bot.get_channel(channel), "topicset", "%s's triggersafe channel. | [rules][mode]" % user.nick)
-        bot.changed()
+        for channel in bot.personal_channels(user):
+            setattr(channel, "topicset", "%s's triggersafe channel. | [rules][mode]" % user.nick)
+            bot.rules_dirty(channel)
+        bot.changed(user)
 
     @command("When unset, the MOTD will be displayed in your channel.\n"
              "unset motdread")
@@ -2787,10 +3786,10 @@ def register_commands():
         if recipient:
             bot.send_and_log(recipient, user_executed,
                 "MOTD marked as unread. The channel topic for your triggersafe channel(s) will be updated soon.")
-        for channel in bot.channels:
-            if channel.endswith("_%s" % user.nick.lower()):
-                setattr(bot.get_channel(channel), "topicset", "%s's triggersafe channel. | [globalmotd][rules][mode]" % user.nick)
-        bot.changed()
+        for channel in bot.personal_channels(user):
+            setattr(channel, "topicset", "%s's triggersafe channel. | [globalmotd][rules][mode]" % user.nick)
+            bot.rules_dirty(channel)
+        bot.changed(user)
 
     @command("When set, being logged in with NickServ will log you in with triggerbot.\n"
              "set nickservlogin")
@@ -2823,7 +3822,7 @@ def register_commands():
         user.password = bcrypt.hashpw(' '.join(params), bcrypt.gensalt())
         bot.send_and_log(recipient, user_executed,
             "Password set.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When unset, your account will not be password protected.\n"
              "unset password")
@@ -2837,7 +3836,7 @@ def register_commands():
             user.logged_in = False
         bot.send_and_log(recipient, user_executed,
             "Password protection removed.")
-        bot.changed()
+        bot.changed(master)
 
     @command("When set, triggerbot will keep a trigger-safe copy available"
              " for each of the channels for you, in which all messages"
@@ -2852,22 +3851,15 @@ def register_commands():
     def set_channel(bot, params, user_executed, recipient, mainchannel, bypass=False):
         user = bot.check_for_master(user_executed)
         user.channel = True
-        for channel in bot.channels.keys():
-            if is_channel_name(channel):
-                userchannel = False
-                try:
-                    if channel.split("_")[1]:
-                        userchannel = True
-                except IndexError:
-                    pass
-                if not userchannel:
-                    tocheck = "%s_%s" % (channel, user.nick)
-                    tocheck = tocheck.lower()
-                    if not tocheck in bot.channels.keys():
-                        bot.join_channel(tocheck)
+        for channel in bot.base_channels():
+            if is_channel_name(channel.name):
+                tocheck = "%s_%s" % (channel, user.nick)
+                tocheck = tocheck.lower()
+                if not tocheck in bot.channels:
+                    bot.join_channel(tocheck)
         bot.send_and_log(recipient, user_executed,
             "Trigger-safe channels are now available for you.")
-        bot.changed()
+        bot.changed(user)
 
     @command("When unset, triggerbot will no longer keep a trigger-safe"
              " copy of each of the channels available for you.\n"
@@ -2877,22 +3869,12 @@ def register_commands():
     def unset_channel(bot, params, user_executed, recipient, mainchannel, bypass=False):
         user = bot.check_for_master(user_executed)
         user.channel = False
-        for channel in bot.channels.keys():
-            if is_channel_name(channel):
-                userchannel = False
-                try:
-                    if channel.split("_")[1]:
-                        userchannel = True
-                except IndexError:
-                    pass
-                if not userchannel:
-                    tocheck = "%s_%s" % (channel, user.nick)
-                    tocheck = tocheck.lower()
-                    if tocheck in bot.channels.keys():
-                        bot.leave_channel(tocheck, unregister=True)
+        for channel in bot.personal_channels(user):
+            if is_channel_name(channel.name):
+                bot.leave_channel(channel.name, unregister=True)
         bot.send_and_log(recipient, user_executed,
             "Trigger-safe channels are no longer available for you.")
-        bot.changed()
+        bot.changed(user)
 
     @command("Check the status of an account option.\n"
              "status <option>")
@@ -2943,9 +3925,10 @@ def register_commands():
             else:
                 user.topics[topic] = level
             x = x + 2
+        bot.triggers_changed(user)
         bot.send_and_log(recipient, user_executed, "Topic(s) added.")
         bot.update_rules()
-        bot.changed()
+        bot.changed(user)
 
     @command("Removes one or more trigger topic(s) for you.\n"
              "topic remove <topic>")
@@ -2959,9 +3942,10 @@ def register_commands():
                 del user.topics[topic]
             except KeyError:
                 bot.send_and_log(recipient, user_executed, "Could not find topic %r" % params[x].lower())
+        bot.triggers_changed(user)
         bot.send_and_log(recipient, user_executed, "Topic(s) removed.")
         bot.update_rules()
-        bot.changed()
+        bot.changed(user)
 
     @command("Lists trigger topics.\n"
              "topic list - Lists your own triggers.\n"
@@ -3110,7 +4094,7 @@ def register_commands():
                     user.trusts.append(entry)
             bot.send_and_log(recipient, user_executed,
                 "The requested users were added to your trust list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -3126,7 +4110,7 @@ def register_commands():
                     user.trusts.remove(entry)
             bot.send_and_log(recipient, user_executed,
                 "The requested users are no longer on your trust list.")
-            bot.changed()
+            bot.changed(user)
         else:
             raise MissingParams
 
@@ -3187,7 +4171,8 @@ def register_commands():
         user = bot.check_for_master(user_executed)
         user.trigger_words.clear()
         user.topics.clear()
-        bot.changed()
+        bot.triggers_changed(user)
+        bot.changed(user)
         bot.send_and_log(recipient, user_executed,
             "All your data are gone. I hope it's what you wanted.")
         bot.update_rules()
@@ -3199,15 +4184,17 @@ def register_commands():
 
     @command("Adds one or more trigger word(s) for you. Users will be warned when they use"
              " this word while you are present.\n"
+             "Put phrases of more than one word between double quotes, and regular expressions"
+             " between slashes, like /[0-9]{3}-[0-9]{4}/.\n"
              "word add <word>")
     @protected_command
     @toggleable_command
     def word_add(bot, params, user_executed, recipient, mainchannel, bypass=False):
         if len(params) > 0:
             user = bot.check_for_master(user_executed)
-            for entry in params:
-                user.trigger_words.add(bot.stem(entry.lower()))
-            bot.changed()
+            user.trigger_words.update([bot.trigger_term(entry) for entry in group_phrases(params)])
+            bot.triggers_changed(user)
+            bot.changed(user)
             bot.send_and_log(recipient, user_executed,
                 "Trigger word(s) added.")
         else:
@@ -3220,9 +4207,9 @@ def register_commands():
     def word_remove(bot, params, user_executed, recipient, mainchannel, bypass=False):
         if len(params) > 0:
             user = bot.check_for_master(user_executed)
-            for entry in params:
-                user.trigger_words.discard(bot.stem(entry.lower()))
-            bot.changed()
+            user.trigger_words.difference_update([bot.trigger_term(entry) for entry in group_phrases(params)])
+            bot.triggers_changed(user)
+            bot.changed(user)
             bot.send_and_log(recipient, user_executed,
                 "Trigger word(s) removed.")
         else:
@@ -3248,12 +4235,10 @@ def register_commands():
              "word who <word>")
     @toggleable_command
     def word_who(bot, params, user, recipient, mainchannel, bypass=False):
-        word = bot.stem(params[0])
-        users = set()
-        for channel in bot.channels.itervalues():
-            for u in channel.users:
-                if word in u.trigger_words:
-                    users.add(u)
+        if not params:
+            raise MissingParams
+        word = bot.trigger_term(group_phrases(params)[0])
+        users = {u for u in bot.trigger_index.who(word) if bot.memberships.channels_of(u)}
         if users:
             bot.send_and_log(recipient, user,
                 "The following users have that trigger word: %s."
@@ -3342,9 +4327,9 @@ def register_commands():
                 channeldata = bot.get_channel(channel)
                 if not entry in channeldata.admins:
                     channeldata.admins.append(entry)
+                    bot.changed(channeldata)
         bot.send_and_log(recipient, user,
             "Added the requested user(s) as channel admin for the requested channel(s).")
-        bot.changed()
 
     @command("Remove a channel admin.\n"
              "admin channel admin remove <channel(s)> <user(s)>")
@@ -3359,9 +4344,9 @@ def register_commands():
                 channeldata = bot.get_channel(channel)
                 if entry in channeldata.admins:
                     channeldata.admins.remove(entry)
+                    bot.changed(channeldata)
         bot.send_and_log(recipient, user,
             "Removed the requested user(s) as channel admin for the requested channel(s).")
-        bot.changed()
 
     @command("Order the bot to join one or more channel(s).\n"
              "admin channel join <channel(s)>")
@@ -3422,6 +4407,7 @@ def register_commands():
     @logged_command
     def admin_check_database(bot, params, user_executed, recipient, mainchannel, bypass=False):
         bot.check_database(recipient, user_executed)
+        bot.trigger_index.rebuild(bot.users.itervalues())
         bot.send_and_log(recipient, user_executed,
             "Check complete.")
 
@@ -3459,9 +4445,14 @@ def register_commands():
             for level in topic.descriptions.keys():
                 export.append("!admin topic add %s %s %s" % (topic.name, level, topic.descriptions[level]))
             for level in topic.words.keys():
-                export.append("!admin topic word add %s %s %s" % (topic.name, level, ' '.join(topic.words[level])))
+                export.append("!admin topic word add %s %s %s" % (topic.name, level, ' '.join(quote_phrase(word) for word in topic.words[level])))
             for supersede in topic.supersedes:
                 export.append("!admin topic supersede add %s %s" % (topic.name, supersede))
+            for level in topic.examples.keys():
+                for example in topic.examples[level]:
+                    export.append("!admin topic example add %s %s %s" % (topic.name, level, example))
+            if topic.threshold is not None:
+                export.append("!admin topic threshold %s %s" % (topic.name, topic.threshold))
         with open(filename, "w") as f:
             f.write('\n'.join(export))
         bot.send_and_log(recipient, user_executed, "All topics have been exported.")
@@ -3486,7 +4477,7 @@ def register_commands():
             for topic in user.topics.keys():
                 export.append("!admin user %s topic add %s %s" % (user.nick, topic.name, user.topics[topic]))
             if user.trigger_words:
-                export.append("!admin user %s word add %s" % (user.nick, ' '.join(user.trigger_words)))
+                export.append("!admin user %s word add %s" % (user.nick, ' '.join(quote_phrase(word) for word in user.trigger_words)))
             if user.admin:
                 export.append("!admin add %s" % user.nick)
             if user.master:
@@ -3721,6 +4712,7 @@ def register_commands():
                 bot.command_description(params[1:])
                 if not "_".join(params[1:]) in user.admincommandsallowed:
                     user.admincommandsallowed.append("_".join(params[1:]))
+                    bot.changed(user)
                     bot.send_and_log(recipient, user_executed,
                         "%s is now allowed to run the command %r" %
                         (params[0], " ".join(params[1:])))
@@ -3743,6 +4735,7 @@ def register_commands():
                 params.insert(1, "admin")
             if "_".join(params[1:]) in user.admincommandsallowed:
                 user.admincommandsallowed.remove("_".join(params[1:]))
+                bot.changed(user)
                 bot.send_and_log(recipient, user_executed,
                     "%s is no longer allowed to run the command %r" %
                     (params[0], " ".join(params[1:])))
@@ -3792,7 +4785,98 @@ def register_commands():
             bot.send_and_log(recipient, user, "Global MOTD disabled.")
         for userloop in bot.users:
             bot.dispatch(command="unset motdread", user=bot.get_user(userloop), reply_to=None, bypass=True)
-        bot.changed()
+        # Every channel topic can show the MOTD
+        bot.rules_dirty()
+        bot.changed(bot.get_settings())
+
+    @command("Also match trigger words written with up to this many typos.\n"
+             "admin set fuzzydistance <1|2>")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_set_fuzzydistance(bot, params, user, recipient, mainchannel, bypass=False):
+        if not params:
+            raise MissingParams
+        try:
+            distance = int(params[0])
+        except ValueError:
+            raise BadValue(params[0])
+        if not distance in (1, 2):
+            raise BadValue(params[0])
+        bot.get_settings().fuzzydistance = distance
+        bot.trigger_index.vocabulary.set_fuzzy_distance(distance)
+        bot.verdicts_changed()
+        bot.send_and_log(recipient, user,
+            "Trigger words now also match with up to %d typo(s)." % distance)
+        bot.changed(bot.get_settings())
+
+    @command("Only match trigger words spelled exactly.\n"
+             "admin unset fuzzydistance")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_unset_fuzzydistance(bot, params, user, recipient, mainchannel, bypass=False):
+        bot.get_settings().fuzzydistance = 0
+        bot.trigger_index.vocabulary.set_fuzzy_distance(0)
+        bot.verdicts_changed()
+        bot.send_and_log(recipient, user, "Fuzzy matching disabled.")
+        bot.changed(bot.get_settings())
+
+    @command("Gather changes for this many seconds before updating channel rules and topics, so bursts of\n"
+             "joins, parts and away changes cause one update. Rules never lag behind more than %d seconds.\n"
+             "admin set rulesdelay <seconds>" % RULES_MAX_STALENESS)
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_set_rulesdelay(bot, params, user, recipient, mainchannel, bypass=False):
+        if not params:
+            raise MissingParams
+        try:
+            delay = int(params[0])
+        except ValueError:
+            raise BadValue(params[0])
+        if not 0 <= delay <= RULES_MAX_STALENESS:
+            raise BadValue(params[0])
+        bot.get_settings().rulesdelay = delay
+        bot.rules_scheduler.delay = delay
+        bot.send_and_log(recipient, user,
+            "Channel rules and topics are now updated after gathering changes for %d second(s)." % delay)
+        bot.changed(bot.get_settings())
+
+    @command("Update channel rules and topics right after every change.\n"
+             "admin unset rulesdelay")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_unset_rulesdelay(bot, params, user, recipient, mainchannel, bypass=False):
+        bot.get_settings().rulesdelay = 0
+        bot.rules_scheduler.delay = 0
+        bot.rules_scheduler.flush()
+        bot.send_and_log(recipient, user, "Channel rules and topics are now updated right away.")
+        bot.changed(bot.get_settings())
+
+    @command("Also detect topics by scoring messages against topic words, descriptions and examples.\n"
+             "Only topics with a threshold set are detected this way.\n"
+             "admin set topicdetection")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_set_topicdetection(bot, params, user, recipient, mainchannel, bypass=False):
+        bot.get_settings().topicdetection = True
+        bot.verdicts_changed()
+        bot.send_and_log(recipient, user, "Topic detection enabled.")
+        bot.changed(bot.get_settings())
+
+    @command("Only detect topics by their words.\n"
+             "admin unset topicdetection")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_unset_topicdetection(bot, params, user, recipient, mainchannel, bypass=False):
+        bot.get_settings().topicdetection = False
+        bot.verdicts_changed()
+        bot.send_and_log(recipient, user, "Topic detection disabled.")
+        bot.changed(bot.get_settings())
 
     @command("Disable the main channels.\n"
              "admin set maindisabled")
@@ -3818,6 +4902,14 @@ def register_commands():
         else:
             bot.send_and_log(recipient, user, "Main channels are already enabled.")
 
+    @command("Show internal performance counters.\n"
+             "admin stats")
+    @admin_command
+    @protected_command
+    def admin_stats(bot, params, user_executed, recipient, mainchannel, bypass=False):
+        for line in bot.stats() or ["No statistics are available."]:
+            bot.send_and_log(recipient, user_executed, line)
+
     @command("Manage which commands are enabled or disabled.")
     def admin_togglecommand(bot, params, user, recipient, mainchannel, bypass=False):
         raise BadCommand
@@ -3837,7 +4929,7 @@ def register_commands():
                     bot.send_and_log(recipient, user_executed,
                         "Command %r is no longer disabled." %
                         " ".join(params))
-                    bot.changed()
+                    bot.changed(bot.get_settings())
                 else:
                     bot.send_and_log(recipient, user_executed,
                         "Command %r has not been disabled." %
@@ -3860,7 +4952,7 @@ def register_commands():
                 bot.send_and_log(recipient, user_executed,
                     "Command %r and all its subcommands are now disabled." %
                     " ".join(params))
-                bot.changed()
+                bot.changed(bot.get_settings())
             else:
                 bot.send_and_log(recipient, user_executed,
                     "Command %r and all its subcommands were already disabled." %
@@ -3902,7 +4994,9 @@ def register_commands():
                 topic = Topic(name)
                 bot.topics[topic.name] = topic
             topic.descriptions[level] = description
-            bot.changed()
+            bot.index_topic(topic)
+            bot.rules_wording_changed()
+            bot.changed(topic)
             bot.send_and_log(recipient, user, "It is done.")
         else:
             raise MissingParams
@@ -3913,6 +5007,8 @@ def register_commands():
 
     @command("Add words to a topic.\n"
              "These words will be used to detect the topic a certain message is about.\n"
+             "Put phrases of more than one word between double quotes, and regular expressions"
+             " between slashes.\n"
              "admin topic word add <name> <level> <list>")
     @admin_command
     @protected_command
@@ -3923,10 +5019,11 @@ def register_commands():
             level = int(params[1])
             if not level in topic.words.keys():
                topic.words[level] = []
-            for word in params[2:]:
-                if not bot.stem(word.lower()) in topic.words[level]:
-                    topic.words[level].append(bot.stem(word.lower()))
-            bot.changed()
+            for term in [bot.trigger_term(word) for word in group_phrases(params[2:])]:
+                if not term in topic.words[level]:
+                    topic.words[level].append(term)
+            bot.topic_changed(topic)
+            bot.changed(topic)
             bot.send_and_log(recipient, user, "Words added")
         else:
             raise MissingParams
@@ -3941,10 +5038,11 @@ def register_commands():
         if len(params) > 2:
             topic = bot.find_topic(params[0].lower())
             level = int(params[1])
-            for word in params[2:]:
-                if bot.stem(word.lower()) in topic.words[level]:
-                    topic.words[level].remove(word.lower())
-            bot.changed()
+            for term in [bot.trigger_term(word) for word in group_phrases(params[2:])]:
+                if term in topic.words[level]:
+                    topic.words[level].remove(term)
+            bot.topic_changed(topic)
+            bot.changed(topic)
             bot.send_and_log(recipient, user, "Words removed")
         else:
             raise MissingParams
@@ -3972,12 +5070,150 @@ def register_commands():
         if len(params) >= 2:
             level = int(params[1])
             del topic.descriptions[level]
+            bot.index_topic(topic)
         else:
             del bot.topics[topic.name]
+            bot.topic_detector.remove_topic(topic.name)
+            bot.verdicts_changed()
+        bot.rules_wording_changed()
             # Note that some users might still refer to this topic.
-        bot.changed()
+        bot.changed(topic, *[entry for entry in bot.users.itervalues() if topic in entry.topics])
         bot.send_and_log(recipient, user, "Topic removed.")
 
+    @command("Manage example sentences used for topic detection.")
+    def admin_topic_example(bot, params, user, recipient, mainchannel, bypass=False):
+        raise BadCommand
+
+    @command("Add an example of a message about a topic.\n"
+             "admin topic example add <name> <level> <sentence>")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_topic_example_add(bot, params, user, recipient, mainchannel, bypass=False):
+        if len(params) > 2:
+            topic = bot.find_topic(params[0].lower())
+            level = int(params[1])
+            topic.examples.setdefault(level, []).append(" ".join(params[2:]))
+            bot.index_topic(topic)
+            bot.changed(topic)
+            bot.send_and_log(recipient, user, "Example added.")
+        else:
+            raise MissingParams
+
+    @command("Remove an example from a topic.\n"
+             "admin topic example remove <name> <level> <number>")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_topic_example_remove(bot, params, user, recipient, mainchannel, bypass=False):
+        if len(params) > 2:
+            topic = bot.find_topic(params[0].lower())
+            level = int(params[1])
+            number = int(params[2])
+            try:
+                if number < 1:
+                    raise IndexError
+                del topic.examples.get(level, [])[number-1]
+            except IndexError:
+                raise BadValue(params[2])
+            if not topic.examples[level]:
+                del topic.examples[level]
+            bot.index_topic(topic)
+            bot.changed(topic)
+            bot.send_and_log(recipient, user, "Example removed.")
+        else:
+            raise MissingParams
+
+    @command("List the examples of a topic.\n"
+             "admin topic example list <name>")
+    @admin_command
+    @protected_command
+    def admin_topic_example_list(bot, params, user, recipient, mainchannel, bypass=False):
+        if params:
+            topic = bot.find_topic(params[0].lower())
+            if not topic.examples:
+                bot.send_and_log(recipient, user, "%s has no examples." % topic.name)
+            for level in sorted(topic.examples):
+                for number, example in enumerate(topic.examples[level]):
+                    bot.send_and_log(recipient, user, "Level %s, %s: %s" % (level, number+1, example))
+        else:
+            raise MissingParams
+
+    @command("Set the minimum score for a message to be detected as being about a topic.\n"
+             "Without a score, the topic is only detected by its words.\n"
+             "admin topic threshold <name> [<score>]")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_topic_threshold(bot, params, user, recipient, mainchannel, bypass=False):
+        if params:
+            topic = bot.find_topic(params[0].lower())
+            if len(params) > 1:
+                try:
+                    topic.threshold = float(params[1])
+                except ValueError:
+                    raise BadValue(params[1])
+                bot.send_and_log(recipient, user, "Threshold set.")
+            else:
+                topic.threshold = None
+                bot.send_and_log(recipient, user, "Threshold removed.")
+            bot.index_topic(topic)
+            bot.changed(topic)
+        else:
+            raise MissingParams
+
+    @command("Show how a message scores against each topic, to help choosing thresholds.\n"
+             "admin topic score <message>")
+    @admin_command
+    @protected_command
+    def admin_topic_score(bot, params, user, recipient, mainchannel, bypass=False):
+        if params:
+            scores = bot.topic_detector.score(term for word, term in bot.tokenize(" ".join(params)))
+            if not scores:
+                bot.send_and_log(recipient, user, "That message doesn't match any topic.")
+            for score, name, level in scores[:5]:
+                bot.send_and_log(recipient, user, "%s level %s: %.3f (threshold: %s)"
+                    % (name, level, score, bot.topics[name].threshold if name in bot.topics else None))
+        else:
+            raise MissingParams
+
+    @command("Show how many chat lines of the bot's log would be hidden from someone having a topic.\n"
+             "A rotated log next to the current one can be given by its file name.\n"
+             "admin topic coverage <name> <level> [<log file>]")
+    @admin_command
+    @protected_command
+    @logged_command
+    def admin_topic_coverage(bot, params, user, recipient, mainchannel, bypass=False):
+        if len(params) > 1:
+            topic = bot.find_topic(params[0].lower())
+            try:
+                level = int(params[1])
+            except ValueError:
+                raise BadValue(params[1])
+            name = " ".join(params[2:])
+            filename = bot.log_path(name)
+            if filename is None:
+                raise BadValue(name or "(no log file)")
+            sample = User("(coverage)")
+            sample.topics[topic] = level
+            def audit(lines):
+                # Audit a chunk at a time, so the bot keeps relaying meanwhile
+                hidden = [0]
+                def chunks():
+                    for start in xrange(0, len(lines), AUDIT_CHUNK):
+                        hidden[0] += sum(1 for unsafe in bot.audit(lines[start:start+AUDIT_CHUNK], [sample]) if unsafe)
+                        yield None
+                return task.cooperate(chunks()).whenDone().addCallback(lambda ignored: report(hidden[0], len(lines)))
+            def report(hidden, total):
+                bot.send_and_log(recipient, user, "%d of %d lines (%d%%) would be hidden from someone with %s level %d."
+                    % (hidden, total, 100 * hidden / total if total else 0, topic.name, level))
+            def unreadable(failure):
+                failure.trap(IOError)
+                bot.send_and_log(recipient, user, "%s couldn't be read." % os.path.basename(filename))
+            threads.deferToThread(read_audit_lines, filename, True).addCallbacks(audit, unreadable).addErrback(log.err)
+        else:
+            raise MissingParams
+
     @command("Manage topic superseding")
     @admin_command
     @protected_command
@@ -3994,7 +5230,8 @@ def register_commands():
         topic = bot.find_topic(params[0])
         for entry in params[1:]:
             topic.supersedes.append(entry)
-        bot.changed()
+        bot.rules_wording_changed()
+        bot.changed(topic)
         bot.send_and_log(recipient, user, "Requested topic(s) will now be superseded by %s." % topic.name)
 
     @command("Remove one or more topic(s) to the list of topics the specified topic supersedes.\n"
@@ -4007,7 +5244,8 @@ def register_commands():
         for entry in params[1:]:
             if entry in topic.supersedes:
                 topic.supersedes.remove(entry)
-        bot.changed()
+        bot.rules_wording_changed()
+        bot.changed(topic)
         bot.send_and_log(recipient, user, "Requested topic(s) will no longer be superseded by %s." % topic.name)
 
     @command("List which topics are superseded by a specific topic.\n"
@@ -4041,6 +5279,7 @@ def register_commands():
         if len(params) > 0:
             user = bot.find_user(params[0])
             user.warnings[datetime.datetime.now()] = None, user_executed.nick, str(" ".join(params[1:])) if len(params) > 1 else None
+            bot.changed(user)
             warningsbytriggerbot = 0
             for entry in user.warnings.keys():
                 if user.warnings[entry][1] == None:
@@ -4142,7 +5381,8 @@ def register_commands():
         target = bot.find_user(params[0])
         target.trigger_words.clear()
         target.topics.clear()
-        bot.changed()
+        bot.triggers_changed(target)
+        bot.changed(target)
         bot.send_and_log(recipient, user,
             "All data for %s are gone. I hope it's what you wanted."
                 % target)
@@ -4170,7 +5410,7 @@ class TriggerBotFactory(protocol.ReconnectingClientFactory):
     # lower exponential backoff value is useful
     factor = 1.6180339887498948
 
-    def __init__(self, channellist, channelsdefined, logger, filename, nickname, identify, identifypassword):
+    def __init__(self, channellist, channelsdefined, logger, filename, nickname, identify, identifypassword, workers=0, storage="pickle", bgsave=False):
         self.channellist = channellist
         self.channelsdefined = channelsdefined
         self.logger = logger
@@ -4178,6 +5418,16 @@ class TriggerBotFactory(protocol.ReconnectingClientFactory):
         self.nickname = nickname
         self.identify = identify
         self.identifypassword = identifypassword
+        self.storage = storage
+        self.bgsave = bgsave
+        # Shared between connections, so the cache survives reconnects
+        self.fold = triggerfilter.FoldCache(10000)
+        self.stem = triggerfilter.StemCache(xapian.Stem("en"))
+        if workers:
+            self.filter_pool = filterpool.FilterPool(workers)
+            self.filter_pool.start()
+        else:
+            self.filter_pool = None
 
     def buildProtocol(self, addr):
         p = TriggerBot()
@@ -4190,7 +5440,11 @@ class TriggerBotFactory(protocol.ReconnectingClientFactory):
         p.identify = self.identify
         if self.identify == True:
             p.identifypassword = self.identifypassword
-        p.stem = xapian.Stem("en")
+        p.fold = self.fold
+        p.stem = self.stem
+        p.filter_pool = self.filter_pool
+        p.storage = self.storage
+        p.bgsave = self.bgsave
         self.resetDelay()
         return p
 
@@ -4210,6 +5464,9 @@ def main():
     logfile = None
     identify = False
     identifypassword = None
+    workers = 0
+    storagekind = "pickle"
+    bgsave = False
 
     serverdefined = False
     portdefined = False
@@ -4241,10 +5498,22 @@ def main():
             logfile = sys.argv[index+1]
         elif arg == "--database" or arg == "-d":
             database = sys.argv[index+1]
+        elif arg == "--workers" or arg == "-w":
+            workers = int(sys.argv[index+1])
+        elif arg == "--storage":
+            storagekind = sys.argv[index+1]
+        elif arg == "--bgsave":
+            bgsave = True
 
     if serverdefined != True or portdefined != True:
         print "Please specify at least the server and port info using --server (-s) and --port (-p) followed by the related information."
         exit(1)
+    if not storagekind in storage.KINDS:
+        print "Please specify one of %s as --storage." % ", ".join(storage.KINDS)
+        exit(1)
+    if bgsave and storagekind != "pickle":
+        print "--bgsave only works with --storage pickle."
+        exit(1)
     log.startLogging(sys.stdout)
 
     logger = MessageLogger \
@@ -4254,6 +5523,64 @@ def main():
     global reconnectondc
     reconnectondc = True
     f = TriggerBotFactory \
-        (channellist=channellist, channelsdefined=channelsdefined, logger=logger, filename=database, nickname=nickname, identify=identify, identifypassword=identifypassword)
+        (channellist=channellist, channelsdefined=channelsdefined, logger=logger, filename=database, nickname=nickname, identify=identify, identifypassword=identifypassword, workers=workers, storage=storagekind, bgsave=bgsave)
     reactor.connectTCP(server, int(port), f)
     reactor.run()
+
+def audit_main():
+    """Check a file of lines against the triggers in a database, offline. Called from audit.py."""
+    database = "triggerbot.db"
+    nicks = []
+    topics = []
+    filename = None
+
+    try:
+        for index, arg in enumerate(sys.argv):
+            if index == 0:
+                continue
+            elif arg == "--database" or arg == "-d":
+                database = sys.argv[index+1]
+            elif arg == "--nick" or arg == "-n":
+                nicks.append(sys.argv[index+1])
+            elif arg == "--topic" or arg == "-t":
+                topics.append((sys.argv[index+1], int(sys.argv[index+2])))
+            elif sys.argv[index-1] in ("--database", "-d", "--nick", "-n", "--topic", "-t") \
+                    or (index > 1 and sys.argv[index-2] in ("--topic", "-t")):
+                continue
+            else:
+                filename = arg
+    except (IndexError, ValueError):
+        print "--database (-d) and --nick (-n) need a value, --topic (-t) needs a topic name and a level."
+        exit(1)
+
+    if filename is None or not os.path.exists(database):
+        print "Please specify an existing database using --database (-d) and a file of lines to check."
+        exit(1)
+
+    bot = TriggerBot()
+    bot.logger = MessageLogger(sys.stderr)
+    bot.filename = database
+    bot.fold = triggerfilter.FoldCache(10000)
+    bot.stem = triggerfilter.StemCache(xapian.Stem("en"))
+    bot.open_database()
+    users = [bot.check_for_master(bot.find_user(nick)) for nick in nicks]
+    for name, level in topics:
+        user = User("(topic %s %d)" % (name, level))
+        user.topics[bot.find_topic(name)] = level
+        users.append(user)
+    if not nicks and not topics:
+        users = [user for user in bot.users.itervalues()
+                 if not user.master and (user.topics or user.trigger_words)]
+
+    lines = read_audit_lines(filename)
+    audited = bot.audit(lines, users)
+    for line, unsafe in zip(lines, audited):
+        for user, verdict in unsafe:
+            reasons = []
+            if verdict[1]:
+                reasons.append("topics: %s" % join_and(", ", " and ", verdict[1]))
+            if verdict[2]:
+                reasons.append("words: %s" % join_and(", ", " and ", verdict[2]))
+            print "%s -> hidden from %s (%s)" % (line, user, "; ".join(reasons))
+    print "%d of %d lines would be hidden from at least one of %d users." % \
+        (len([unsafe for unsafe in audited if unsafe]), len(lines), len(users))
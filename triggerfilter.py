@@ -0,0 +1,941 @@
+# Copyright (c) 2013 Sylvia van Os
+# This file is part of Triggerbot, released under the MIT license
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+
+# This module contains the message filtering engine used by triggerbot.
+# It is kept separate from triggerbot.py so it has no IRC or Twisted
+# dependencies of its own.
+
+import collections
+import re
+import sre_constants
+import sre_parse
+import string
+import time
+import unicodedata
+
+import xapian
+
+try:
+    import numpy
+    import scipy.sparse
+except ImportError:
+    # BulkFilter falls back to plain sets
+    numpy = None
+
+class LRUCache(object):
+    """A size-bounded cache which evicts the least recently used entry."""
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compute):
+        """Return the cached value for key, calling compute(key) on a miss."""
+        try:
+            value = self.entries.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = compute(key)
+            self.misses += 1
+            if len(self.entries) >= self.size:
+                self.entries.popitem(last=False)
+        # (Re-)insert at the most recently used end
+        self.entries[key] = value
+        return value
+
+    def lookup(self, key):
+        """Return the cached value for key, or None, for values computed asynchronously."""
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = value
+        return value
+
+    def store(self, key, value):
+        self.entries.pop(key, None)
+        if len(self.entries) >= self.size:
+            self.entries.popitem(last=False)
+        self.entries[key] = value
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return "%d/%d entries, %d hits, %d misses (%d%% hit rate)" % \
+            (len(self.entries), self.size, self.hits, self.misses,
+             100 * self.hits / lookups if lookups else 0)
+
+# Look-alike letters from other scripts, mapped to the Latin letter they
+# imitate. Only lowercase letters are needed, as fold() lowercases first.
+CONFUSABLES = {
+    u"\u0430": u"a", u"\u0432": u"b", u"\u0435": u"e", u"\u043a": u"k", # Cyrillic
+    u"\u043c": u"m", u"\u043d": u"h", u"\u043e": u"o", u"\u0440": u"p",
+    u"\u0441": u"c", u"\u0442": u"t", u"\u0443": u"y", u"\u0445": u"x",
+    u"\u0455": u"s", u"\u0456": u"i", u"\u0458": u"j", u"\u04bb": u"h",
+    u"\u04cf": u"l", u"\u0501": u"d", u"\u051b": u"q", u"\u051d": u"w",
+    u"\u03b1": u"a", u"\u03b5": u"e", u"\u03b9": u"i", u"\u03ba": u"k", # Greek
+    u"\u03bd": u"v", u"\u03bf": u"o", u"\u03c1": u"p", u"\u03c4": u"t",
+    u"\u03c5": u"u", u"\u03c7": u"x",
+    u"\u0131": u"i", u"\u0251": u"a", u"\u0261": u"g", # Latin
+}
+
+# Characters which are invisible, or only split what is one word to a reader
+ZERO_WIDTH = u"\u00ad\u180e\u200b\u200c\u200d\u2060\ufeff"
+
+def build_fold_table():
+    table = dict((ord(char), replacement) for char, replacement in CONFUSABLES.iteritems())
+    # Full case folding, which unicode.lower() doesn't do
+    table.update({ord(u"\u00df"): u"ss", ord(u"\u017f"): u"s", ord(u"\u03c2"): u"\u03c3"})
+    for x in xrange(0x10000):
+        if unicodedata.category(unichr(x)).startswith("P"):
+            table[x] = None
+    for char in ZERO_WIDTH:
+        table[ord(char)] = None
+    return table
+
+FOLD_TABLE = build_fold_table()
+
+def fold(word):
+    """
+    Normalize a UTF-8 token, so that variants of a word meant to read the
+    same become the same: NFKC normalization (full-width and stylized
+    letters), case folding, look-alike letters from other scripts, and
+    removal of punctuation and zero-width characters.
+    """
+    text = unicodedata.normalize("NFKC", word.decode("utf-8", "replace")).lower()
+    return text.translate(FOLD_TABLE).encode("utf-8")
+
+class FoldCache(LRUCache):
+    """Callable like fold(), remembering recently folded tokens."""
+    def __call__(self, word):
+        return self.get(word, fold)
+
+class StemCache(LRUCache):
+    """
+    Wraps a stemmer (such as xapian.Stem) so it can be called exactly
+    like one, while remembering recently stemmed words. Chat vocabulary
+    is repetitive enough for most words to be a cache hit.
+    """
+    def __init__(self, stemmer, size=10000):
+        LRUCache.__init__(self, size)
+        self.stemmer = stemmer
+
+    def __call__(self, word):
+        return self.get(word, self.stemmer)
+
+class PhraseMatcher(object):
+    """
+    An Aho-Corasick automaton over sequences of stemmed words.
+    Phrases are given as stemmed words joined by single spaces. Matching
+    is linear in the length of the message, regardless of how many
+    phrases are loaded.
+    """
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+        for phrase in phrases:
+            state = 0
+            for term in phrase.split(" "):
+                nextstate = self.goto[state].get(term)
+                if nextstate is None:
+                    nextstate = len(self.goto)
+                    self.goto[state][term] = nextstate
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                state = nextstate
+            self.output[state].append(phrase)
+        # Breadth-first, so failure links always point to finished states
+        queue = collections.deque(self.goto[0].itervalues())
+        while queue:
+            state = queue.popleft()
+            for term, nextstate in self.goto[state].iteritems():
+                queue.append(nextstate)
+                fallback = self.fail[state]
+                while fallback and not term in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[nextstate] = self.goto[fallback].get(term, 0)
+                self.output[nextstate] = self.output[nextstate] + self.output[self.fail[nextstate]]
+
+    def search(self, terms):
+        """Yields (start, end, phrase) for every phrase found in terms."""
+        state = 0
+        for end, term in enumerate(terms):
+            while state and not term in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(term, 0)
+            for phrase in self.output[state]:
+                yield end - phrase.count(" "), end + 1, phrase
+
+# Longest /pattern/ trigger accepted, not counting the slashes
+MAX_PATTERN_LENGTH = 200
+MAX_BOUNDED_REPEAT = 20 # Quantifiers allowing more repeats than this count as unbounded
+
+def is_pattern(term):
+    """Returns whether a trigger term is a /regular expression/."""
+    return len(term) > 2 and term.startswith("/") and term.endswith("/")
+
+def check_pattern(term):
+    """
+    Raises ValueError if a /pattern/ term is invalid or can't safely be
+    combined with other patterns into a single regular expression.
+    """
+    body = term[1:-1]
+    if len(body) > MAX_PATTERN_LENGTH:
+        raise ValueError("pattern is longer than %d characters" % MAX_PATTERN_LENGTH)
+    # Backreferences, named groups and inline flags break the other
+    # patterns once combined
+    if re.search(r"\\[1-9]|\(\?P[<=]|\(\?[iLmsux]", body):
+        raise ValueError("backreferences, named groups and flags are not supported")
+    try:
+        compiled = re.compile(body)
+    except re.error, e:
+        raise ValueError(str(e))
+    if compiled.search(""):
+        raise ValueError("pattern matches empty text")
+    # Every relayed line is run through the patterns, so patterns which
+    # can backtrack exponentially (or polynomially) would stall the bot
+    items = sre_parse.parse(body).data
+    check_backtracking(items, False)
+    # Each pair of such quantifiers multiplies the ways a line can be tried,
+    # even with other text between them, as in a.*b.*c
+    repeats = open_repeats(items)
+    for x, characters in enumerate(repeats):
+        for other in repeats[x+1:]:
+            if characters & other:
+                raise ValueError("more than one unbounded quantifier matching the same characters is not supported")
+
+# Characters as seen by check_backtracking: ASCII codes, and NON_ASCII for all others
+NON_ASCII = 128
+ALL_CHARACTERS = frozenset(range(NON_ASCII + 1))
+CATEGORIES = {
+    sre_constants.CATEGORY_DIGIT: frozenset(ord(c) for c in string.digits),
+    sre_constants.CATEGORY_SPACE: frozenset(ord(c) for c in " \t\n\r\f\v"),
+    sre_constants.CATEGORY_WORD: frozenset(ord(c) for c in string.ascii_letters + string.digits + "_") | frozenset([NON_ASCII]),
+}
+CATEGORIES[sre_constants.CATEGORY_NOT_DIGIT] = ALL_CHARACTERS - CATEGORIES[sre_constants.CATEGORY_DIGIT]
+CATEGORIES[sre_constants.CATEGORY_NOT_SPACE] = ALL_CHARACTERS - CATEGORIES[sre_constants.CATEGORY_SPACE]
+CATEGORIES[sre_constants.CATEGORY_NOT_WORD] = ALL_CHARACTERS - CATEGORIES[sre_constants.CATEGORY_WORD] | frozenset([NON_ASCII])
+
+def character(code):
+    """ The characters a literal matches, ignoring case like PatternMatcher """
+    if code >= NON_ASCII:
+        return frozenset([NON_ASCII])
+    return frozenset([ord(chr(code).lower()), ord(chr(code).upper())])
+
+def character_set(items):
+    """ The characters a [set] matches """
+    matched = set()
+    negate = False
+    for op, av in items:
+        if op == sre_constants.NEGATE:
+            negate = True
+        elif op == sre_constants.LITERAL:
+            matched.update(character(av))
+        elif op == sre_constants.RANGE:
+            for code in range(av[0], min(av[1], NON_ASCII) + 1):
+                matched.update(character(code))
+            if av[1] >= NON_ASCII:
+                matched.add(NON_ASCII)
+        else:
+            matched.update(CATEGORIES.get(av, ALL_CHARACTERS))
+    if negate:
+        # Negated sets still match other non-ASCII characters
+        return ALL_CHARACTERS - matched | frozenset([NON_ASCII])
+    return frozenset(matched)
+
+def first_characters(items):
+    """ The characters a sequence of parsed items can start with, at most """
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            return character(av)
+        elif op == sre_constants.IN:
+            return character_set(av)
+        elif op == sre_constants.SUBPATTERN:
+            return first_characters(av[1])
+        elif op == sre_constants.BRANCH:
+            return frozenset().union(*[first_characters(branch) for branch in av[1]])
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue
+        else:
+            return ALL_CHARACTERS
+    return frozenset()
+
+def all_characters(items):
+    """ The characters a sequence of parsed items can match, at most """
+    matched = frozenset()
+    for op, av in items:
+        if op == sre_constants.LITERAL:
+            matched |= character(av)
+        elif op == sre_constants.IN:
+            matched |= character_set(av)
+        elif op == sre_constants.SUBPATTERN:
+            matched |= all_characters(av[1])
+        elif op == sre_constants.BRANCH:
+            matched = matched.union(*[all_characters(branch) for branch in av[1]])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            matched |= all_characters(av[2])
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            continue
+        else:
+            return ALL_CHARACTERS
+    return matched
+
+def open_repeats(items):
+    """ What each quantifier in the parsed items allowing more than MAX_BOUNDED_REPEAT repeats can match """
+    repeats = []
+    for op, av in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            if av[1] > MAX_BOUNDED_REPEAT:
+                repeats.append(all_characters(av[2]))
+            repeats.extend(open_repeats(av[2]))
+        elif op == sre_constants.BRANCH:
+            for branch in av[1]:
+                repeats.extend(open_repeats(branch))
+        elif op in (sre_constants.SUBPATTERN, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            repeats.extend(open_repeats(av[1]))
+    return repeats
+
+def check_backtracking(items, repeated, previous=frozenset()):
+    """
+    Raises ValueError for nested quantifiers like (a+)+, quantified text
+    which can be split up in several ways like (a|ab)+ or (a?a)+, and
+    quantifiers which can match the same text in turn like a*a* or
+    \\w+\\s*\\w+. repeated tells whether items are inside a quantifier,
+    previous is what the quantifiers right before items can match.
+    Returns what the quantifiers at the end of items can match.
+    """
+    for op, av in items:
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            low, high, subitems = av
+            characters = first_characters(subitems)
+            if high > 1 and repeated:
+                raise ValueError("nested quantifiers are not supported")
+            if (high > 1 or not low) and previous & characters:
+                raise ValueError("quantifiers matching the same text in turn are not supported")
+            if high > 1:
+                if check_backtracking(subitems, True) & characters:
+                    raise ValueError("quantified text which can be split up in several ways is not supported")
+                # Text skipped by an optional quantifier still sits between the others
+                previous = characters if low else previous | characters
+            elif low:
+                previous = check_backtracking(subitems, repeated, previous)
+            else:
+                previous |= characters | check_backtracking(subitems, repeated, previous)
+        elif op == sre_constants.SUBPATTERN:
+            previous = check_backtracking(av[1], repeated, previous)
+        elif op == sre_constants.BRANCH:
+            if repeated:
+                starts = [first_characters(branch) for branch in av[1]]
+                for x, characters in enumerate(starts):
+                    for other in starts[x+1:]:
+                        if characters & other:
+                            raise ValueError("quantified text which can be split up in several ways is not supported")
+                if any(not branch.getwidth()[0] for branch in av[1]):
+                    raise ValueError("quantified text which can be split up in several ways is not supported")
+            previous = frozenset().union(*[check_backtracking(branch, repeated, previous) for branch in av[1]])
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            check_backtracking(av[1], repeated)
+        elif op != sre_constants.AT:
+            # Inside a quantifier, text after an optional part must tell where it ended
+            if repeated and previous & first_characters([(op, av)]):
+                raise ValueError("quantified text which can be split up in several ways is not supported")
+            previous = frozenset()
+    return previous
+
+class PatternMatcher(object):
+    """
+    Matches a set of /pattern/ trigger terms in a single regex pass.
+    Every pattern becomes an optional lookahead with a named group of its
+    own, so overlapping matches of different patterns are all found. A
+    leading lookahead for any of the patterns lets the scan skip every
+    position at which none of them can match.
+    """
+    def __init__(self, patterns):
+        self.patterns = frozenset(patterns)
+        self.groups = {}
+        bodies = []
+        for x, pattern in enumerate(sorted(self.patterns)):
+            self.groups["p%d" % x] = pattern
+            bodies.append(pattern[1:-1])
+        if bodies:
+            self.regex = re.compile("(?=%s)%s" %
+                ("|".join("(?:%s)" % body for body in bodies),
+                 "".join("(?:(?=(?P<p%d>%s)))?" % (x, body) for x, body in enumerate(bodies))),
+                re.IGNORECASE)
+        else:
+            self.regex = None
+
+    def search(self, message):
+        """Yields (matched text, pattern) for the first match of every pattern."""
+        if self.regex is None:
+            return
+        found = set()
+        for match in self.regex.finditer(message):
+            for group, text in match.groupdict().iteritems():
+                if text is not None and not group in found:
+                    found.add(group)
+                    yield text, self.groups[group]
+
+def topic_term(name, level):
+    """
+    The term standing for a whole topic level, used for topic levels
+    detected by a TopicDetector. As '#' is punctuation, no folded word
+    can ever be mistaken for one.
+    """
+    return "#%s:%d" % (name, level)
+
+def is_topic_term(term):
+    return term.startswith("#")
+
+class TopicDetector(object):
+    """
+    Probabilistic topic detection. Every topic level is a document in an
+    in-memory Xapian database, made of the terms of its words, description
+    and example sentences, and messages are scored against all of them
+    with BM25. A message is about a topic level when it scores at least
+    the topic's threshold; topics without a threshold are never detected.
+    Like a Vocabulary, changes are appended to journal if it is a list.
+    """
+    def __init__(self):
+        self.database = xapian.inmemory_open()
+        self.topics = {} # topic name -> (levels, threshold), as last updated
+        self.documents = {} # topic name -> {level: docid}
+        self.levels = {} # docid -> (topic name, level)
+        self.thresholds = {}
+        self.timings = collections.deque(maxlen=1000) # Seconds per scored message
+        self.journal = None
+
+    def remove_topic(self, name):
+        self._remove_topic(name)
+        if self.journal is not None:
+            self.journal.append(("untopic", name))
+
+    def _remove_topic(self, name):
+        self.topics.pop(name, None)
+        for docid in self.documents.pop(name, {}).itervalues():
+            self.database.delete_document(docid)
+            del self.levels[docid]
+        self.thresholds.pop(name, None)
+
+    def snapshot(self):
+        return [("topic", name, levels, threshold)
+                for name, (levels, threshold) in self.topics.iteritems()]
+
+    def update_topic(self, name, levels, threshold):
+        """(Re-)index a topic given {level: terms} and its threshold."""
+        self._remove_topic(name)
+        if self.journal is not None:
+            self.journal.append(("topic", name, levels, threshold))
+        self.topics[name] = (levels, threshold)
+        self.documents[name] = {}
+        for level, terms in levels.iteritems():
+            if not terms:
+                continue
+            document = xapian.Document()
+            for term in terms:
+                document.add_term(term)
+            docid = self.database.add_document(document)
+            self.documents[name][level] = docid
+            self.levels[docid] = (name, level)
+        if threshold is not None:
+            self.thresholds[name] = threshold
+
+    def score(self, terms):
+        """Returns (score, topic name, level) for every matching topic level, best first."""
+        terms = list(set(terms))
+        if not terms or not self.levels:
+            return []
+        start = time.time()
+        enquire = xapian.Enquire(self.database)
+        enquire.set_query(xapian.Query(xapian.Query.OP_OR, terms))
+        enquire.set_weighting_scheme(xapian.BM25Weight())
+        scores = [(match.weight,) + self.levels[match.docid]
+                  for match in enquire.get_mset(0, len(self.levels))]
+        self.timings.append(time.time() - start)
+        return scores
+
+    def detect(self, terms):
+        """Returns (topic name, level) for every topic level the terms are about."""
+        return [(name, level) for score, name, level in self.score(terms)
+                if name in self.thresholds and score >= self.thresholds[name]]
+
+    def stats(self):
+        if not self.timings:
+            return "%d topic levels, no messages scored yet" % len(self.levels)
+        return "%d topic levels, last %d messages scored in %.2f ms on average, %.2f ms at most" % \
+            (len(self.levels), len(self.timings),
+             1000 * sum(self.timings) / len(self.timings), 1000 * max(self.timings))
+
+def deletes(word, distance):
+    """Returns all variants of word with up to distance characters deleted."""
+    variants = set([word])
+    frontier = [word]
+    for x in range(distance):
+        nextfrontier = []
+        for variant in frontier:
+            for i in range(len(variant)):
+                deleted = variant[:i] + variant[i+1:]
+                if not deleted in variants:
+                    variants.add(deleted)
+                    nextfrontier.append(deleted)
+        frontier = nextfrontier
+    return variants
+
+def edit_distance(a, b):
+    """Levenshtein distance, also counting a transposition as one edit."""
+    previousrow = None
+    row = range(len(b) + 1)
+    for i in range(1, len(a) + 1):
+        newrow = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            newrow[j] = min(row[j] + 1, newrow[j-1] + 1,
+                            row[j-1] + (a[i-1] != b[j-1]))
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                newrow[j] = min(newrow[j], previousrow[j-2] + 1)
+        previousrow, row = row, newrow
+    return row[len(b)]
+
+class FuzzyIndex(object):
+    """
+    A symmetric delete (SymSpell style) index over trigger terms.
+    Every term is stored under all its variants with up to 'distance'
+    characters deleted, so finding the terms close to a word only takes
+    looking up the word's own delete variants, instead of comparing it to
+    every term.
+    Terms and words shorter than distance + 3 characters are never fuzzily
+    matched, as almost any short word is a typo away from another one.
+    """
+    def __init__(self, terms, distance, cachesize=10000):
+        self.distance = distance
+        self.minlength = distance + 3
+        self.variants = {}
+        for term in terms:
+            if len(term) >= self.minlength:
+                for variant in deletes(term, distance):
+                    self.variants.setdefault(variant, set()).add(term)
+        self.cache = LRUCache(cachesize)
+
+    def lookup(self, word):
+        """Returns the terms within the edit distance of word."""
+        return self.cache.get(word, self._lookup)
+
+    def _lookup(self, word):
+        # Stretched spellings ("spiiiiider") count as their shortest form
+        word = re.sub(r"(.)\1{2,}", r"\1\1", word)
+        if len(word) < self.minlength:
+            return ()
+        candidates = set()
+        for variant in deletes(word, self.distance):
+            candidates.update(self.variants.get(variant, ()))
+        return tuple(term for term in candidates
+                     if edit_distance(word, term) <= self.distance)
+
+def tokenize(message, fold, stem):
+    """
+    Split a message into (word, term) tokens, where term is the folded
+    and stemmed word. Words folding to nothing, such as lone punctuation,
+    are left out.
+    """
+    tokens = []
+    for word in message.split():
+        folded = fold(word)
+        if folded:
+            tokens.append((word, stem(folded)))
+    return tokens
+
+class Vocabulary(object):
+    """
+    The set of all trigger terms, along with everything needed to find
+    them in a message. Terms containing a space are phrases, which are
+    matched using a PhraseMatcher that is rebuilt lazily whenever the set
+    of phrases changes.
+    When fuzzy_distance is set, single words which are not a term
+    themselves are looked up in a FuzzyIndex, which is rebuilt lazily
+    whenever the set of single word terms changes.
+    /pattern/ terms are matched against whole messages by a
+    PatternMatcher; recently used matchers are cached by their set of
+    patterns.
+
+    When journal is a list, every change is also appended to it, so the
+    changes can be replayed on a replica (see FilterReplica).
+    """
+    def __init__(self):
+        self.terms = set()
+        self.phrases = set()
+        self.phrase_matcher = None
+        self.patterns = set()
+        self.fuzzy_distance = 0
+        self.fuzzy_index = None
+        self.pattern_matchers = LRUCache(100)
+        self.journal = None
+
+    def add(self, term):
+        self.terms.add(term)
+        if is_pattern(term):
+            self.patterns.add(term)
+        elif " " in term:
+            self.phrases.add(term)
+            self.phrase_matcher = None
+        else:
+            self.fuzzy_index = None
+        if self.journal is not None:
+            self.journal.append(("add", term))
+
+    def remove(self, term):
+        self.terms.discard(term)
+        if is_pattern(term):
+            self.patterns.discard(term)
+        elif " " in term:
+            self.phrases.discard(term)
+            self.phrase_matcher = None
+        else:
+            self.fuzzy_index = None
+        if self.journal is not None:
+            self.journal.append(("remove", term))
+
+    def clear(self):
+        self.terms = set()
+        self.phrases = set()
+        self.phrase_matcher = None
+        self.patterns = set()
+        self.fuzzy_index = None
+        if self.journal is not None:
+            self.journal.append(("clear",))
+
+    def set_fuzzy_distance(self, distance):
+        self.fuzzy_distance = distance
+        self.fuzzy_index = None
+        if self.journal is not None:
+            self.journal.append(("fuzzy", distance))
+
+    def extended(self, terms):
+        """Returns a copy of this vocabulary with some more terms, without a journal."""
+        vocabulary = Vocabulary()
+        vocabulary.fuzzy_distance = self.fuzzy_distance
+        for term in self.terms | set(terms):
+            vocabulary.add(term)
+        return vocabulary
+
+    def snapshot(self):
+        """Returns the changes needed to make an empty replica equal to this vocabulary."""
+        return [("clear",), ("fuzzy", self.fuzzy_distance)] + \
+            [("add", term) for term in self.terms]
+
+    def pattern_matcher(self, patterns=None):
+        """Return a compiled PatternMatcher for a set of /pattern/ terms, by default all of them."""
+        if patterns is None:
+            patterns = self.patterns
+        return self.pattern_matchers.get(frozenset(patterns), PatternMatcher)
+
+    def matched_terms(self, tokens):
+        """
+        Look up every (word, term) token once.
+        Returns a list of (word, term) for every term in the message,
+        including phrases, in which case word is the matched part of the
+        message. For fuzzy matches, word also names the term it was
+        matched to. /pattern/ terms are not included.
+        """
+        if self.fuzzy_distance:
+            if self.fuzzy_index is None:
+                self.fuzzy_index = FuzzyIndex((term for term in self.terms
+                                               if not " " in term and not is_pattern(term)
+                                               and not is_topic_term(term)),
+                                              self.fuzzy_distance)
+            matched = []
+            for word, term in tokens:
+                if term in self.terms:
+                    matched.append((word, term))
+                else:
+                    for fuzzyterm in self.fuzzy_index.lookup(term):
+                        matched.append(("%s (%s)" % (word, fuzzyterm), fuzzyterm))
+        else:
+            matched = [(word, term) for word, term in tokens if term in self.terms]
+        if self.phrases:
+            if self.phrase_matcher is None:
+                self.phrase_matcher = PhraseMatcher(self.phrases)
+            terms = [term for word, term in tokens]
+            for start, end, phrase in self.phrase_matcher.search(terms):
+                matched.append((" ".join(word for word, term in tokens[start:end]), phrase))
+        return matched
+
+def match_all(vocabulary, topic_detector, tokens, message, detect):
+    """
+    Returns the (word, term) matches in a tokenized message, including all
+    /pattern/ terms and, if detect is set, detected topic levels.
+    """
+    matched = vocabulary.matched_terms(tokens)
+    if vocabulary.patterns:
+        matched.extend(vocabulary.pattern_matcher().search(message))
+    if detect:
+        for name, level in topic_detector.detect(term for word, term in tokens):
+            matched.append((name, topic_term(name, level)))
+    return matched
+
+def explain_reasons(matched, reasons_of):
+    """
+    Returns (badtopics, badwords) for matched terms, in the order the words
+    appeared, where reasons_of(term) gives a user's reasons for a term.
+    """
+    badtopics = []
+    badwords = []
+    for word, term in matched:
+        for reason in reasons_of(term):
+            if reason is None:
+                if not word in badwords:
+                    badwords.append(word)
+            elif not reason[0] in badtopics:
+                badtopics.append(reason[0])
+    return badtopics, badwords
+
+class TriggerProfile(object):
+    """
+    A user's compiled trigger words and topics. Every term maps to a
+    frozenset containing None for a personal trigger word and (topic name,
+    level) for every topic level the term was inherited from. Profiles
+    are never changed; a new one is compiled instead.
+    """
+    __slots__ = ("reasons", "terms", "patterns", "versions")
+
+    def __init__(self, reasons, versions):
+        self.reasons = dict((term, frozenset(why)) for term, why in reasons.iteritems())
+        self.terms = frozenset(self.reasons)
+        self.patterns = frozenset(term for term in self.terms if is_pattern(term))
+        # topic name -> version of the topic this profile was compiled from
+        self.versions = versions
+
+    def __nonzero__(self):
+        return bool(self.reasons)
+
+    def explain(self, matched):
+        """
+        Returns (badtopics, badwords) given the result of matched_terms,
+        in the order the words appeared.
+        """
+        return explain_reasons(matched, lambda term: self.reasons.get(term, ()))
+
+EMPTY_PROFILE = TriggerProfile({}, {})
+
+class TriggerIndex(object):
+    """
+    An inverted index from stemmed trigger terms to the users they
+    belong to, and every user's compiled TriggerProfile.
+
+    Topics are versioned, so profiles compiled from a topic that has
+    changed since are recompiled. The terms themselves are kept in a
+    Vocabulary, which is what messages are matched against.
+    """
+    def __init__(self):
+        # term -> set of users
+        self.postings = {}
+        self.profiles = {}
+        # topic name -> version, and topic name -> users having that topic
+        self.topic_versions = {}
+        self.subscribers = {}
+        self.vocabulary = Vocabulary()
+
+    def user_reasons(self, user):
+        """Return {term: reasons} for a user's trigger words and topics."""
+        terms = {}
+        for word in user.trigger_words:
+            terms.setdefault(word, set()).add(None)
+        for topic, level in user.topics.iteritems():
+            for x in range(1, level+1):
+                for word in topic.words.get(x, ()):
+                    terms.setdefault(word, set()).add((topic.name, x))
+                terms[topic_term(topic.name, x)] = set([(topic.name, x)])
+        return terms
+
+    def compile(self, user):
+        """Compile a user's TriggerProfile, without indexing it."""
+        versions = dict((topic.name, self.topic_versions.get(topic.name, 0)) for topic in user.topics)
+        return TriggerProfile(self.user_reasons(user), versions)
+
+    def remove_user(self, user):
+        profile = self.profiles.pop(user, EMPTY_PROFILE)
+        for name in profile.versions:
+            self.subscribers[name].discard(user)
+            if not self.subscribers[name]:
+                del self.subscribers[name]
+        for term in profile.terms:
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            posting.discard(user)
+            if not posting:
+                del self.postings[term]
+                self.vocabulary.remove(term)
+
+    def update_user(self, user):
+        """(Re-)index a single user after their triggers changed."""
+        self.remove_user(user)
+        profile = self.compile(user)
+        if not profile:
+            return profile
+        for term in profile.terms:
+            if not term in self.postings:
+                self.vocabulary.add(term)
+                self.postings[term] = set()
+            self.postings[term].add(user)
+        for name in profile.versions:
+            self.subscribers.setdefault(name, set()).add(user)
+        self.profiles[user] = profile
+        return profile
+
+    def profile(self, user):
+        """Return a user's up to date TriggerProfile."""
+        profile = self.profiles.get(user, EMPTY_PROFILE)
+        for name, version in profile.versions.iteritems():
+            if self.topic_versions.get(name, 0) != version:
+                return self.update_user(user)
+        return profile
+
+    def topic_changed(self, name):
+        """
+        Outdate the profiles compiled from a topic, returning the users
+        having it, whose profiles should be updated.
+        """
+        self.topic_versions[name] = self.topic_versions.get(name, 0) + 1
+        return list(self.subscribers.get(name, ()))
+
+    def rebuild(self, users):
+        self.postings = {}
+        self.profiles = {}
+        self.subscribers = {}
+        self.vocabulary.clear()
+        for user in users:
+            self.update_user(user)
+
+    def matched_terms(self, tokens):
+        return self.vocabulary.matched_terms(tokens)
+
+    def explain(self, user, matched):
+        """
+        Returns (badtopics, badwords) for a user given the result of
+        matched_terms, in the order the words appeared.
+        """
+        return self.profile(user).explain(matched)
+
+    def who(self, term):
+        """Return the users having term as a personal trigger word."""
+        return [user for user in self.postings.get(term, ())
+                if None in self.profiles[user].reasons[term]]
+
+class FilterReplica(object):
+    """
+    A copy of a Vocabulary and TopicDetector, kept up to date by replaying
+    their journals, which matches messages on its own. Used by the worker
+    processes of filterworker.py.
+    """
+    def __init__(self, stemmer):
+        self.fold = FoldCache(10000)
+        self.stem = StemCache(stemmer)
+        self.vocabulary = Vocabulary()
+        self.topic_detector = TopicDetector()
+
+    def apply(self, change):
+        operation = change[0]
+        if operation == "reset":
+            self.vocabulary = Vocabulary()
+            self.topic_detector = TopicDetector()
+        elif operation == "add":
+            self.vocabulary.add(change[1])
+        elif operation == "remove":
+            self.vocabulary.remove(change[1])
+        elif operation == "clear":
+            self.vocabulary.clear()
+        elif operation == "fuzzy":
+            self.vocabulary.set_fuzzy_distance(change[1])
+        elif operation == "topic":
+            self.topic_detector.update_topic(*change[1:])
+        elif operation == "untopic":
+            self.topic_detector.remove_topic(change[1])
+        else:
+            raise ValueError("unknown change %r" % operation)
+
+    def matched_terms(self, message, detect):
+        tokens = tokenize(message, self.fold, self.stem)
+        return match_all(self.vocabulary, self.topic_detector, tokens, message, detect)
+
+class BulkFilter(object):
+    """
+    Evaluates batches of matched messages for many users at once.
+    Messages are encoded as a sparse message x term matrix and the users'
+    trigger terms as a term x user matrix, and a nonzero entry in their
+    product means a message is unsafe for a user. Without NumPy and SciPy,
+    the same product is computed using sets.
+    """
+    def __init__(self, profiles):
+        """profiles is a list of (user, {term: reasons}), see TriggerIndex.user_reasons."""
+        self.users = [user for user, reasons in profiles]
+        self.profiles = dict(profiles)
+        self.term_users = {} # term -> user columns
+        for column, (user, reasons) in enumerate(profiles):
+            for term in reasons:
+                self.term_users.setdefault(term, []).append(column)
+        self.rows = dict((term, row) for row, term in enumerate(self.term_users))
+        if numpy is not None and self.term_users:
+            rows = []
+            columns = []
+            for term, termcolumns in self.term_users.iteritems():
+                rows.extend([self.rows[term]] * len(termcolumns))
+                columns.extend(termcolumns)
+            self.matrix = scipy.sparse.csr_matrix(
+                (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+                shape=(len(self.rows), len(self.users)))
+        else:
+            self.matrix = None
+
+    def unsafe(self, batch):
+        """Given the matched terms of every message, returns the users each one is unsafe for."""
+        if self.matrix is None:
+            results = []
+            for matched in batch:
+                columns = set()
+                for word, term in matched:
+                    columns.update(self.term_users.get(term, ()))
+                results.append([self.users[column] for column in sorted(columns)])
+            return results
+        rows = []
+        columns = []
+        for row, matched in enumerate(batch):
+            for term in set(term for word, term in matched):
+                column = self.rows.get(term)
+                if column is not None:
+                    rows.append(row)
+                    columns.append(column)
+        messages = scipy.sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=numpy.int32), (rows, columns)),
+            shape=(len(batch), len(self.rows)))
+        hits = messages.dot(self.matrix).tocsr()
+        return [[self.users[column] for column in sorted(hits.indices[hits.indptr[row]:hits.indptr[row+1]])]
+                for row in range(len(batch))]
+
+    def explain(self, user, matched):
+        reasons = self.profiles[user]
+        return explain_reasons(matched, lambda term: reasons.get(term, ()))